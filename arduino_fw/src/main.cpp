@@ -4,14 +4,62 @@
 #define WIDTH 20
 #define HEIGHT 10
 #define NUM_LEDS WIDTH * HEIGHT
-
+#define FRAME_BYTES (NUM_LEDS * 3)
 
 #define DATA_PIN 3
 
+// Frame format (see NeoPixelController in spooky.py):
+// SYNC0 SYNC1 TYPE LEN_LO LEN_HI <LEN bytes of payload> CHECKSUM
+// The checksum is the 8 bit sum of TYPE, LEN_LO, LEN_HI and the payload.
+#define SYNC0 0xAA
+#define SYNC1 0x55
+
+// Frame types, all colors are in GRB order:
+//   RAW:     every pixel, 3 bytes each
+//   DELTA:   spans of changed pixels as [start lo, start hi, count, count * 3 bytes]
+//   PALETTE: [color count, colors * 3 bytes, one 4 bit color index per pixel]
+//   RLE:     runs of identical pixels as [count, 3 bytes]
+#define FRAME_RAW 0
+#define FRAME_DELTA 1
+#define FRAME_PALETTE 2
+#define FRAME_RLE 3
+
+#define MAX_PALETTE_COLORS 16
+#define MAX_PAYLOAD (FRAME_BYTES * 2)
+
 // Define the array of leds
 CRGB leds[NUM_LEDS];
 
-void setup() { 
+enum ParserState {
+  WAIT_SYNC0,
+  WAIT_SYNC1,
+  READ_TYPE,
+  READ_LEN_LO,
+  READ_LEN_HI,
+  READ_PAYLOAD,
+  READ_CHECKSUM
+};
+
+ParserState state = WAIT_SYNC0;
+uint8_t frame_type = 0;
+uint16_t frame_length = 0;
+uint16_t data_length = 0;
+uint8_t checksum = 0;
+bool frame_error = false;
+
+// leds holds the last good frame, so deltas can be applied on top of it.
+// Cleared whenever a frame is lost and set again by the next full frame.
+bool in_sync = false;
+
+// Decoder state shared by the frame types
+uint16_t pixel = 0;
+uint16_t span_left = 0;
+uint8_t field[4];
+uint8_t field_pos = 0;
+uint8_t palette_colors = 0;
+uint8_t palette[MAX_PALETTE_COLORS][3];
+
+void setup() {
     Serial.begin(230400);
     FastLED.addLeds<WS2812B, DATA_PIN>(leds, NUM_LEDS);  // GRB ordering is assumed
     FastLED.setBrightness(20);
@@ -22,40 +70,225 @@ void setup() {
 
 }
 
-long long int last_serial = 0;
+unsigned long last_serial = 0;
+bool blanked = true;
 
-void loop() { 
-  int data_length = 0;
+void set_pixel(uint16_t index, const uint8_t *color) {
+  if (index >= NUM_LEDS) {
+    frame_error = true;
+    return;
+  }
+  leds[index].raw[0] = color[0];
+  leds[index].raw[1] = color[1];
+  leds[index].raw[2] = color[2];
+}
 
-  while (data_length < NUM_LEDS * 3){
-    int led = data_length / 3;
-    int color = data_length % 3;
-    if(Serial.available()>0){
-      leds[led].raw[color] = (uint8_t)Serial.read();
-      data_length++;
-      last_serial = millis();
+bool is_valid_length(uint8_t type, uint16_t length) {
+  switch (type) {
+    case FRAME_RAW:
+      return length == FRAME_BYTES;
+    case FRAME_DELTA:
+      return length <= MAX_PAYLOAD;
+    case FRAME_PALETTE:
+      return length > 0 && length <= 1 + MAX_PALETTE_COLORS * 3 + (NUM_LEDS + 1) / 2;
+    case FRAME_RLE:
+      return length > 0 && length % 4 == 0 && length <= NUM_LEDS * 4;
+  }
+  return false;
+}
+
+void start_payload() {
+  data_length = 0;
+  pixel = 0;
+  span_left = 0;
+  field_pos = 0;
+  palette_colors = 0;
+  frame_error = false;
+}
+
+void decode_raw(uint8_t value) {
+  leds[data_length / 3].raw[data_length % 3] = value;
+}
+
+void decode_rle(uint8_t value) {
+  field[field_pos++] = value;
+  if (field_pos < 4) {
+    return;
+  }
+  field_pos = 0;
+  uint8_t count = field[0];
+  uint8_t color[3] = {field[1], field[2], field[3]};
+  for (uint8_t i = 0; i < count; i++) {
+    set_pixel(pixel++, color);
+  }
+}
+
+void decode_palette(uint8_t value) {
+  if (data_length == 0) {
+    palette_colors = value;
+    if (palette_colors == 0 || palette_colors > MAX_PALETTE_COLORS) {
+      frame_error = true;
     }
+    return;
+  }
 
-    if(millis() - last_serial > 1000){
-      digitalWrite(13, LOW);
-      FastLED.clear();
-      FastLED.show();
-    } else {
-      digitalWrite(13, HIGH);
-      
+  uint16_t offset = data_length - 1;
+  if (offset < palette_colors * 3) {
+    palette[offset / 3][offset % 3] = value;
+    return;
+  }
+
+  uint8_t indices[2] = {(uint8_t)(value >> 4), (uint8_t)(value & 0x0F)};
+  for (uint8_t i = 0; i < 2 && pixel < NUM_LEDS; i++) {
+    if (indices[i] >= palette_colors) {
+      frame_error = true;
+      return;
     }
+    set_pixel(pixel++, palette[indices[i]]);
   }
-  
-  FastLED.show();
+}
 
-  // Wait for the start of the next frame
-  if(data_length == NUM_LEDS * 3){
-    while(Serial.available() > 0){
-      Serial.read();
-      
+void decode_delta(uint8_t value) {
+  if (span_left == 0) {
+    // Reading a span header: start lo, start hi, count
+    field[field_pos++] = value;
+    if (field_pos == 3) {
+      field_pos = 0;
+      pixel = field[0] | ((uint16_t)field[1] << 8);
+      span_left = (uint16_t)field[2] * 3;
+      if (span_left == 0 || pixel + field[2] > NUM_LEDS) {
+        frame_error = true;
+      }
     }
+    return;
   }
 
-  
+  // Only draw on top of a frame we know is intact
+  if (in_sync && !frame_error) {
+    leds[pixel].raw[field_pos] = value;
+  }
+  if (++field_pos == 3) {
+    field_pos = 0;
+    pixel++;
+  }
+  span_left--;
+}
+
+void decode_byte(uint8_t value) {
+  switch (frame_type) {
+    case FRAME_RAW:
+      decode_raw(value);
+      break;
+    case FRAME_DELTA:
+      decode_delta(value);
+      break;
+    case FRAME_PALETTE:
+      decode_palette(value);
+      break;
+    case FRAME_RLE:
+      decode_rle(value);
+      break;
+  }
+}
+
+bool is_complete_frame() {
+  switch (frame_type) {
+    case FRAME_DELTA:
+      return span_left == 0 && field_pos == 0;
+    case FRAME_PALETTE:
+    case FRAME_RLE:
+      return pixel == NUM_LEDS;
+  }
+  return true;
+}
+
+// Feed one byte to the frame parser. Returns true when a complete, valid frame is in leds.
+bool parse_byte(uint8_t value) {
+  switch (state) {
+    case WAIT_SYNC0:
+      if (value == SYNC0) {
+        state = WAIT_SYNC1;
+      }
+      break;
+
+    case WAIT_SYNC1:
+      if (value == SYNC1) {
+        state = READ_TYPE;
+      } else if (value != SYNC0) {
+        state = WAIT_SYNC0;
+      }
+      break;
+
+    case READ_TYPE:
+      frame_type = value;
+      checksum = value;
+      state = READ_LEN_LO;
+      break;
+
+    case READ_LEN_LO:
+      frame_length = value;
+      checksum += value;
+      state = READ_LEN_HI;
+      break;
+
+    case READ_LEN_HI:
+      frame_length |= (uint16_t)value << 8;
+      checksum += value;
+      start_payload();
+      if (!is_valid_length(frame_type, frame_length)) {
+        // Misaligned or corrupt header, go back to hunting for sync
+        state = WAIT_SYNC0;
+      } else {
+        state = frame_length > 0 ? READ_PAYLOAD : READ_CHECKSUM;
+      }
+      break;
 
-}
\ No newline at end of file
+    case READ_PAYLOAD:
+      decode_byte(value);
+      checksum += value;
+      data_length++;
+      if (data_length == frame_length) {
+        state = READ_CHECKSUM;
+      }
+      break;
+
+    case READ_CHECKSUM:
+      state = WAIT_SYNC0;
+      if (value != checksum || frame_error || !is_complete_frame()) {
+        // leds may be partly overwritten now, wait for the next full frame
+        in_sync = false;
+        return false;
+      }
+      if (frame_type == FRAME_DELTA) {
+        // An empty delta is just a keep-alive, nothing to redraw
+        return in_sync && frame_length > 0;
+      }
+      in_sync = true;
+      return true;
+  }
+  return false;
+}
+
+void loop() {
+  while (Serial.available() > 0) {
+    last_serial = millis();
+    if (parse_byte((uint8_t)Serial.read())) {
+      FastLED.show();
+      blanked = false;
+    }
+  }
+
+  // Blank the LEDs if the host stops sending data
+  if (millis() - last_serial > 1000) {
+    digitalWrite(13, LOW);
+    state = WAIT_SYNC0;
+    if (!blanked) {
+      FastLED.clear();
+      FastLED.show();
+      blanked = true;
+      in_sync = false;
+    }
+  } else {
+    digitalWrite(13, HIGH);
+  }
+}
@@ -0,0 +1,430 @@
+import os
+import io
+import json
+import time
+import wave
+import queue
+import random
+import argparse
+import tempfile
+import datetime
+import platform
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+import spooky
+from trace_summary import percentile, load_durations
+
+# Offline benchmarks for the pumpkin. Chat and speech run against local stub servers that
+# imitate the OpenAI chat endpoint and the Coqui XTTS + audio_url flow, with configurable
+# latency and jitter, so changes can be compared without API credits or the network.
+# Frame rendering and serial packing are timed on their own.
+#
+# Usage: python benchmark.py [--save results.json] [--compare baseline.json]
+
+prompt_file = os.path.abspath("prompt.md")
+
+# Stub answers, {n} is the request number so every line is a new clip for the speech stub
+stub_answers = [
+    "[BEN] [HAPPY] Welcome, visitor number {n}! [MAL] [ANGRY] Another one who dares to bother me. [BEN] [HAPPY] Don't mind him, he's just hungry.",
+    "[MAL] [ANGRY] Question {n}? I have heard it a thousand times, mortal! [BEN] [THINKING] Let me think about that one for a moment.",
+    "[BEN] [HAPPY] Oh, I love that question, number {n} is my favourite. [MAL] [ANGRY] Leave now, before the candles go out!"
+]
+
+stub_questions = [
+    "hey pumpkin what are you doing this weekend",
+    "what would you tell your maker",
+    "are you real",
+    "what is your favourite candy",
+    "can you see me"
+]
+
+
+class StubLatency():
+    # Delay in seconds before a response starts, uniformly jittered by +/- jitter
+    def __init__(self, latency, jitter) -> None:
+        self.latency = latency
+        self.jitter = jitter
+
+    def wait(self):
+        time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+
+class StubServer(ThreadingHTTPServer):
+    # Serves POST /v1/chat/completions (streaming or not), POST /api/v2/samples/xtts and
+    # GET /audio/<id>.wav on one local port.
+    daemon_threads = True
+
+    def __init__(self, chat_latency, token_delay, tts_latency, download_latency, words_per_second=2.5) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.chat_latency = chat_latency
+        self.token_delay = token_delay
+        self.tts_latency = tts_latency
+        self.download_latency = download_latency
+        self.words_per_second = words_per_second
+        self.sample_rate = spooky.AudioOutput.sample_rate
+
+        self.lock = Lock()
+        self.chat_requests = 0
+        self.samples = {}  # sample id -> wav bytes
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def next_answer(self):
+        with self.lock:
+            self.chat_requests += 1
+            n = self.chat_requests
+        return stub_answers[n % len(stub_answers)].format(n=n)
+
+    def synthesize(self, text):
+        # A tone as long as the line would take to say
+        duration = max(0.5, len(text.split()) / self.words_per_second)
+        t = np.arange(int(duration * self.sample_rate)) / self.sample_rate
+        pcm = (np.sin(2 * np.pi * 220 * t) * 8000).astype(np.int16)
+        data = io.BytesIO()
+        with wave.open(data, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(pcm.tobytes())
+        with self.lock:
+            sample_id = str(len(self.samples))
+            self.samples[sample_id] = data.getvalue()
+        return sample_id
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoints
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        if self.path.endswith("/chat/completions"):
+            self.chat_completion(self.read_json())
+        elif self.path == "/api/v2/samples/xtts":
+            self.xtts_sample(self.read_json())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_GET(self):
+        sample_id = self.path.rsplit("/", 1)[-1].replace(".wav", "")
+        if not self.path.startswith("/audio/") or sample_id not in self.server.samples:
+            self.send_json(404, {"error": "not found"})
+            return
+        self.server.download_latency.wait()
+        data = self.server.samples[sample_id]
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def chat_completion(self, request):
+        answer = self.server.next_answer()
+        self.server.chat_latency.wait()
+        completion = {"id": "chatcmpl-bench", "created": int(time.time()), "model": request.get("model", "gpt-4")}
+
+        if not request.get("stream"):
+            words = len(answer.split())
+            self.send_json(200, dict(completion, object="chat.completion",
+                choices=[{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                usage={"prompt_tokens": 100, "completion_tokens": words, "total_tokens": 100 + words}))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        tokens = [" " + word if i else word for i, word in enumerate(answer.split(" "))]
+        for token in tokens:
+            chunk = dict(completion, object="chat.completion.chunk", choices=[{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+            self.send_chunk(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+            self.server.token_delay.wait()
+        chunk = dict(completion, object="chat.completion.chunk", choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        self.send_chunk(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def xtts_sample(self, request):
+        self.server.tts_latency.wait()
+        sample_id = self.server.synthesize(request.get("text", ""))
+        self.send_json(201, {"id": sample_id, "audio_url": self.server.url + "/audio/" + sample_id + ".wav"})
+
+
+class ClipCollector():
+    # Stands in for the speaker: takes clips off the voice timeline queue and marks when each
+    # interaction has its first clip ready to play.
+    def __init__(self, voice: spooky.Voice_Control) -> None:
+        self.voice = voice
+        self.lock = Lock()
+        self.clips = {}  # trace id -> clips received
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                clip = self.voice.audio_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            clip.trace.mark("first_clip_ready")
+            clip.trace.record("clip_ready", clip.created_time, time.time(), ok=clip.pcm is not None)
+            with self.lock:
+                self.clips[clip.trace.trace_id] = self.clips.get(clip.trace.trace_id, 0) + 1
+
+    def wait_for(self, trace, count, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if self.clips.get(trace.trace_id, 0) >= count:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+def run_end_to_end(mode, server, questions, work_dir, stream=True):
+    # One question at a time through the chat and speech pipeline, like visitors taking turns.
+    # Returns the per stage durations of every interaction.
+    trace_path = os.path.join(work_dir, mode + "_traces.jsonl")
+    tracer = spooky.Tracer(trace_path)
+    voice = spooky.Voice_Control(clip_cache=spooky.ClipCache(os.path.join(work_dir, mode + "_tts_cache")))
+    voice.api_base = server.url
+    chat = spooky.Chat_Interface(prompt_file=prompt_file, stream=stream, response_cache=spooky.ResponseCache(ttl=0),
+                                 chat_log=spooky.ChatLog(os.path.join(work_dir, mode + "_chat_logs")))
+    collector = ClipCollector(voice)
+
+    if mode == "async":
+        pipeline = spooky.AsyncPipeline(chat, voice)
+        pipeline.start()
+    else:
+        chat.register_segment_callback(voice.speak)
+        voice.synthesis_pool.acquire()
+        chat.start()
+
+    for i in range(questions):
+        question = stub_questions[i % len(stub_questions)]
+        trace = tracer.new_trace(mode)
+        answer_queue = queue.Queue(1)
+        with trace.span("answer"):
+            if mode == "async":
+                answer = pipeline.submit(question, trace).result()
+            else:
+                chat.ask(question, answer_queue, trace)
+                answer = answer_queue.get()
+        parser = spooky.PersonaParser()
+        if not collector.wait_for(trace, len(parser.feed(answer) + parser.flush())):
+            print("Timed out waiting for speech of question " + str(i))
+        trace.mark("all_clips_ready")
+
+    if mode == "async":
+        pipeline.stop()
+    else:
+        chat.unregister_segment_callback(voice.speak)
+        chat.stop()
+        voice.synthesis_pool.release()
+    collector.stop()
+    tracer.file.close()
+
+    durations, traces = load_durations([trace_path])
+    return durations
+
+
+# (cached question, asked question, should the cached answer be used)
+cache_checks = [
+    ("what is your favorite food", "what is your favorite color", False),
+    ("are you real", "are you ready", False),
+    ("whats your name", "whats your game", False),
+    ("who are you", "where are you", False),
+    ("where were you born", "when were you born", False),
+    ("what do you eat", "why do you eat", False),
+    ("who made you", "what made you", False),
+    ("why are you orange", "are you orange", False),
+    ("do cats eat dogs", "do dogs eat cats", False),
+    ("what is your favorite candy on halloween", "what is your least favorite candy on halloween", False),
+    ("do you like candy", "do you not like candy", False),
+    ("what is your name", "hey pumpkin what's your name?", True),
+    ("are you real", "Are you REAL?!", True),
+    ("who's your favorite monster", "hey pumpkin whos your favorite monster", True),
+    ("what do you do", "what are you", False),
+    ("who are you", "hey pumpkin who are you", True),
+    ("tell me a scary story about ghosts and witches and goblins and bats and spiders tonight",
+     "tell me a scary story about ghosts and witches and goblins and bats and spiders", True)
+]
+
+def check_response_cache():
+    # A wrong answer from the cache is worse than a slow one, so near misses must not match
+    failures = []
+    for cached, asked, should_hit in cache_checks:
+        cache = spooky.ResponseCache()
+        cache.put(cached, "answer")
+        if (cache.get(asked) is not None) != should_hit:
+            failures.append(f'"{asked}" {"missed" if should_hit else "matched"} "{cached}"')
+    if failures:
+        raise SystemExit("Response cache check failed: " + "; ".join(failures))
+    print(f"Response cache check passed ({len(cache_checks)} questions)")
+
+
+def time_calls(function, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(i)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def run_render(frames, baked):
+    # Time every show in each of its speaking / evil variants, live or from baked frame banks
+    output = np.zeros((spooky.ARRAY_HEIGHT, spooky.ARRAY_WIDTH, 3), np.uint8)
+    show_control = spooky.ShowControl(spooky.show_list, spooky.ARRAY_WIDTH, spooky.ARRAY_HEIGHT)
+    spooky.frame_banks.enabled = baked
+    durations = {}
+    rendered = []
+    for name, show in spooky.show_list.items():
+        for speaking in (False, True):
+            for evil_factor in (False, True):
+                spooky.show_state.set(spooky.ShowState(speaking=speaking, evil_factor=evil_factor, mouth_level=0.5))
+                if baked:
+                    show(show_control.grid_x, show_control.grid_y, 0)
+                    spooky.frame_banks.wait()
+                def render(i):
+                    output[:] = show(show_control.grid_x, show_control.grid_y, i)
+                    if name != "None":
+                        rendered.append(output.copy())
+                variant = name + (" speaking" if speaking else "") + (" evil" if evil_factor else "")
+                durations[("bake " if baked else "render ") + variant] = time_calls(render, frames)
+    spooky.show_state.set(spooky.ShowState())
+    spooky.frame_banks.enabled = True
+    return durations, rendered
+
+
+def run_packing(frames):
+    # Pack consecutive frames of each show, the way they arrive at the controller
+    durations = {}
+    sizes = {}
+    for compression in (False, True):
+        controller = spooky.NeoPixelController("benchmark", spooky.FrameBuffer(frames[0].shape), compression=compression)
+        total = [0]
+        def pack(i):
+            total[0] += len(controller.pack_frame(frames[i]))
+        name = "pack " + ("compressed" if compression else "raw")
+        durations[name] = time_calls(pack, len(frames))
+        sizes[name] = total[0] / len(frames)
+    return durations, sizes
+
+
+def summarize(durations):
+    summary = {}
+    for stage, values in durations.items():
+        values = sorted(values)
+        summary[stage] = {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99)
+        }
+    return summary
+
+
+def print_summary(results, baseline=None):
+    print(f'{"benchmark":<36}{"count":>7}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"vs p50":>9}')
+    for name, stats in results["stages"].items():
+        change = ""
+        if baseline is not None and name in baseline["stages"] and baseline["stages"][name]["p50"] > 0:
+            change = f'{100 * (stats["p50"] / baseline["stages"][name]["p50"] - 1):+.0f}%'
+        print(f'{name:<36}{stats["count"]:>7}{stats["p50"] * 1000:>10.3f}{stats["p95"] * 1000:>10.3f}{stats["p99"] * 1000:>10.3f}{change:>9}')
+    for name, size in results.get("bytes_per_frame", {}).items():
+        print(f'{name + " bytes per frame":<36}{size:>7.0f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for chat, speech, rendering and serial packing")
+    parser.add_argument("--questions", type=int, default=10, help="questions per end to end run")
+    parser.add_argument("--chat-latency", type=float, default=0.6, help="seconds before the chat stub answers")
+    parser.add_argument("--token-delay", type=float, default=0.03, help="seconds between streamed tokens")
+    parser.add_argument("--tts-latency", type=float, default=1.5, help="seconds before the speech stub answers")
+    parser.add_argument("--download-latency", type=float, default=0.2, help="seconds before audio downloads start")
+    parser.add_argument("--jitter", type=float, default=0.25, help="+/- fraction of each latency, picked at random per request")
+    parser.add_argument("--frames", type=int, default=300, help="frames per render and packing benchmark")
+    parser.add_argument("--skip-end-to-end", action="store_true", help="only run the rendering and packing benchmarks")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="show the change against results saved earlier")
+    args = parser.parse_args()
+
+    results = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": platform.platform(),
+        "settings": vars(args),
+        "stages": {}
+    }
+
+    check_response_cache()
+
+    render_durations, frames = run_render(args.frames, baked=False)
+    results["stages"].update(summarize(render_durations))
+    bake_durations, baked_frames = run_render(args.frames, baked=True)
+    results["stages"].update(summarize(bake_durations))
+    pack_durations, results["bytes_per_frame"] = run_packing(frames)
+    results["stages"].update(summarize(pack_durations))
+
+    if not args.skip_end_to_end:
+        os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+        jittered = lambda latency: StubLatency(latency, latency * args.jitter)
+        server = StubServer(jittered(args.chat_latency), jittered(args.token_delay), jittered(args.tts_latency), jittered(args.download_latency))
+        server.start()
+        spooky.openai.api_base = server.url + "/v1"
+
+        # Chat logs and clip caches go in a scratch directory, not next to the real ones
+        repo_dir = os.getcwd()
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            for mode in ("threads", "async"):
+                durations = run_end_to_end(mode, server, args.questions, work_dir)
+                results["stages"].update({mode + " " + stage: stats for stage, stats in summarize(durations).items()})
+            os.chdir(repo_dir)
+        server.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    print_summary(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to " + args.save)
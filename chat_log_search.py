@@ -0,0 +1,102 @@
+import os
+import re
+import sys
+import gzip
+import json
+import argparse
+import datetime
+
+# Search the chat logs written by spooky.py (chat_logs/) by time range, persona, role or keyword.
+# Keywords match whole words, the same way index.jsonl lists them, so rotated logs are only
+# opened when their line in the index says they can match.
+# Usage: python chat_log_search.py [--since 2023-10-31] [--until "2023-10-31 21:00"]
+#                                  [--persona Malevolent] [--role user] [keyword ...]
+
+# Same as ChatLog.word_pattern in spooky.py
+word_pattern = re.compile(r"[a-z0-9']+")
+
+def parse_time(text):
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+def load_index(log_dir):
+    entries = []
+    try:
+        with open(os.path.join(log_dir, "index.jsonl"), "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+def entry_matches(entry, since, until, persona, words):
+    if since is not None and entry["end"] < since:
+        return False
+    if until is not None and entry["start"] > until:
+        return False
+    if persona is not None and persona not in entry["personas"]:
+        return False
+    return words.issubset(entry["words"])
+
+def record_matches(record, since, until, persona, role, words):
+    if since is not None and record["time"] < since:
+        return False
+    if until is not None and record["time"] > until:
+        return False
+    if persona is not None and persona not in record.get("personas", []):
+        return False
+    if role is not None and record["role"] != role:
+        return False
+    return words.issubset(word_pattern.findall(record["text"].lower()))
+
+def read_records(f):
+    for line in f:
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            continue  # a line cut short when the script was stopped
+
+def search(log_dir, since=None, until=None, persona=None, role=None, keywords=()):
+    words = set(word for keyword in keywords for word in word_pattern.findall(keyword.lower()))
+
+    files = [entry["file"] for entry in sorted(load_index(log_dir), key=lambda entry: entry["start"])
+             if entry_matches(entry, since, until, persona, words)]
+    for name in files:
+        with gzip.open(os.path.join(log_dir, name), "rt") as f:
+            for record in read_records(f):
+                if record_matches(record, since, until, persona, role, words):
+                    yield record
+
+    # The log being written isn't indexed yet
+    try:
+        with open(os.path.join(log_dir, "current.jsonl"), "r") as f:
+            for record in read_records(f):
+                if record_matches(record, since, until, persona, role, words):
+                    yield record
+    except FileNotFoundError:
+        pass
+
+def format_record(record):
+    time = datetime.datetime.fromtimestamp(record["time"]).strftime("%Y-%m-%d %H:%M:%S")
+    return f'[{time}] {record["role"]}: {record["text"]}'
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Search the pumpkin's chat logs")
+    parser.add_argument("keywords", nargs="*", help="only messages containing all of these words")
+    parser.add_argument("--dir", default="chat_logs", help="log directory (default chat_logs)")
+    parser.add_argument("--since", type=parse_time, help="start time, e.g. 2023-10-31 or \"2023-10-31 19:00\"")
+    parser.add_argument("--until", type=parse_time, help="end time, same format as --since")
+    parser.add_argument("--persona", choices=["Benevolent", "Malevolent"], help="only answers where this persona speaks")
+    parser.add_argument("--role", choices=["user", "assistant", "system"])
+    args = parser.parse_args(argv)
+
+    count = 0
+    for record in search(args.dir, args.since, args.until, args.persona, args.role, args.keywords):
+        print(format_record(record))
+        count += 1
+    print(str(count) + " messages", file=sys.stderr)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
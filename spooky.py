@@ -1,10 +1,13 @@
 import numpy as np
 import serial
-from threading import Thread, Event, Lock
+from threading import Thread, Event, Lock, Condition, current_thread
 import queue
+from collections import deque, OrderedDict
 import time
 import random
 import os
+import sys
+import signal
 
 from pygame import mixer
 
@@ -17,19 +20,41 @@ try:
 except (ImportError, RuntimeError):
   is_rpi = False
 
-import tkinter as tk
-from PIL import Image, ImageTk
+try:
+  import vosk
+  has_vosk = True
+except ImportError:
+  has_vosk = False
+
+try:
+  import tiktoken
+  has_tiktoken = True
+except ImportError:
+  has_tiktoken = False
 
 import requests
+import asyncio
+import aiohttp
 from pydub import AudioSegment
-from pydub.playback import play
 import io
+import wave
 import re
+import json
+import hashlib
+import gzip
+import shutil
+import marshal
+import unicodedata
 
 import datetime
+import contextlib
+import contextvars
+import uuid
+import functools
+import difflib
 
 import speech_recognition as sr
-import sounddevice  # supresses a warning from speech_recognition on rpi
+import sounddevice  # audio output and microphone capture, also supresses a warning from speech_recognition on rpi
 
 import logging
 import http.client
@@ -49,30 +74,423 @@ requests_cache.install_cache('my_simple_cache')
 HEADERS = {"User-Agent": "Mozilla/5.0 (X11; CrOS x86_64 12871.102.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.141 Safari/537.36"}
 
 
+class Tracer():
+    # Writes timing spans of every interaction (button press to audio out) to a JSONL file, one
+    # record per span: {"trace", "origin", "stage", "start", "end", "duration", ...}.
+    # Summarize a night of traces with trace_summary.py.
+    def __init__(self, path="traces.jsonl") -> None:
+        self.path = path
+        self.lock = Lock()
+        self.file = None
+
+    def new_trace(self, origin):
+        return Trace(self, uuid.uuid4().hex[:12], origin)
+
+    def write(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write(line + "\n")
+            self.file.flush()
+
+
+class Trace():
+    def __init__(self, tracer, trace_id, origin) -> None:
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.origin = origin
+        self.start_time = time.time()
+        self.marks = set()
+
+    def record(self, stage, start, end, **fields):
+        if self.tracer is None:
+            return
+        self.tracer.write({"trace": self.trace_id, "origin": self.origin, "stage": stage,
+                           "start": start, "end": end, "duration": end - start, **fields})
+
+    @contextlib.contextmanager
+    def span(self, stage, **fields):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.time(), **fields)
+
+    def mark(self, stage, **fields):
+        # Time from the start of the interaction, only the first mark of each stage counts
+        if stage in self.marks:
+            return
+        self.marks.add(stage)
+        self.record(stage, self.start_time, time.time(), **fields)
+
+
+# The interaction being handled by the current thread or asyncio task. Clips carry their own
+# trace once they move between threads.
+untraced = Trace(None, None, "none")
+current_trace = contextvars.ContextVar("current_trace", default=untraced)
+tracer = Tracer()
+
+
+class EventBus():
+    # Hands events from the threads that produce them (render, chat, voice, speech) to the
+    # subscribers without running subscriber code on the producer's thread. Every subscriber
+    # has its own queue and is delivered to in one of three ways:
+    #   on its own delivery thread (the default),
+    #   through post(function), e.g. an asyncio loop's call_soon_threadsafe or Pumpkin.post,
+    #   or by calling poll() itself, e.g. from the Tk thread.
+    # Coalesced subscribers only keep the latest pending event (frames, partial transcriptions),
+    # the others drop their oldest event once max_pending are waiting.
+    stats_interval = 30
+    stats_window = 300
+
+    class Subscription():
+        def __init__(self, bus, topic, callback, coalesce, post, poll, max_pending) -> None:
+            self.bus = bus
+            self.topic = topic
+            self.callback = callback
+            self.name = topic + " -> " + getattr(callback, "__qualname__", str(callback))
+            self.coalesce = coalesce
+            self.post = post
+            self.max_pending = 1 if coalesce else max_pending
+            self.pending = deque()  # (publish time, context, args)
+            self.scheduled = False
+            self.closed = False
+            self.condition = Condition()
+
+            self.delivered = 0
+            self.dropped = 0
+            self.latencies = deque(maxlen=bus.stats_window)
+
+            self.thread = None
+            if post is None and not poll:
+                self.thread = Thread(target=self.run, name="Events " + self.name, daemon=True)
+                self.thread.start()
+
+        def push(self, event):
+            with self.condition:
+                if self.closed:
+                    return
+                if len(self.pending) >= self.max_pending:
+                    self.pending.popleft()
+                    self.dropped += 1
+                self.pending.append(event)
+                wake = self.post is not None and not self.scheduled
+                self.scheduled = self.scheduled or wake
+                self.condition.notify()
+            if wake:
+                self.post(self.poll)
+
+        def poll(self):
+            # Deliver everything pending on the calling thread
+            while True:
+                with self.condition:
+                    if not self.pending or self.closed:
+                        self.scheduled = False
+                        return
+                    (published, context, args) = self.pending.popleft()
+                self.deliver(published, context, args)
+
+        def deliver(self, published, context, args):
+            self.latencies.append(time.monotonic() - published)
+            self.delivered += 1
+            try:
+                # Run in the publisher's context, so the current trace follows the event
+                context.run(self.callback, *args)
+            except Exception as e:
+                print("Error delivering " + self.name + ": " + str(e))
+
+        def run(self):
+            while True:
+                with self.condition:
+                    while not self.pending and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    (published, context, args) = self.pending.popleft()
+                self.deliver(published, context, args)
+
+        def close(self):
+            with self.condition:
+                self.closed = True
+                self.pending.clear()
+                self.condition.notify()
+            if self.thread is not None and self.thread is not current_thread():
+                self.thread.join()
+
+        def get_stats(self):
+            latencies = np.array(self.latencies) * 1000
+            p50, p95 = np.percentile(latencies, [50, 95]) if len(latencies) else (0.0, 0.0)
+            return {"delivered": self.delivered, "dropped": self.dropped, "pending": len(self.pending),
+                    "latency_ms_p50": float(p50), "latency_ms_p95": float(p95)}
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.subscriptions = {}  # topic -> [Subscription]
+        self.stats_start = time.monotonic()
+
+    def subscribe(self, topic, callback, coalesce=False, post=None, poll=False, max_pending=256) -> Subscription:
+        subscription = self.Subscription(self, topic, callback, coalesce, post, poll, max_pending)
+        with self.lock:
+            names = [s.name for s in self.subscriptions.get(topic, [])]
+            if subscription.name in names:
+                subscription.name += " #" + str(len(names))
+            # Copy on write, publish() iterates without the lock
+            self.subscriptions[topic] = self.subscriptions.get(topic, []) + [subscription]
+        return subscription
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            subscriptions = self.subscriptions.get(topic, [])
+            removed = [s for s in subscriptions if s.callback == callback]
+            self.subscriptions[topic] = [s for s in subscriptions if s.callback != callback]
+        for subscription in removed:
+            subscription.close()
+
+    def publish(self, topic, *args):
+        event = (time.monotonic(), contextvars.copy_context(), args)
+        for subscription in self.subscriptions.get(topic, ()):
+            subscription.push(event)
+
+        if event[0] - self.stats_start >= self.stats_interval:
+            self.stats_start = event[0]
+            self.print_stats()
+
+    def get_stats(self):
+        with self.lock:
+            subscriptions = [s for topic in self.subscriptions.values() for s in topic]
+        return {s.name: s.get_stats() for s in subscriptions}
+
+    def print_stats(self):
+        for name, stats in self.get_stats().items():
+            print(f'Events {name}: {stats["delivered"]} delivered, {stats["dropped"]} dropped, latency p50 {stats["latency_ms_p50"]:.1f} ms, p95 {stats["latency_ms_p95"]:.1f} ms')
+
+    def close(self):
+        with self.lock:
+            subscriptions = [s for topic in self.subscriptions.values() for s in topic]
+            self.subscriptions = {}
+        for subscription in subscriptions:
+            subscription.close()
+
+
+class FrameBuffer():
+    # Hands rendered frames from the show thread to the readers (serial output, GUI) without
+    # copying and without tearing. The renderer fills a spare buffer from begin_write() and
+    # commit()s it, which makes it the newest frame and bumps the sequence number. Readers
+    # borrow the newest complete frame with read(). The renderer never writes into the newest
+    # or a borrowed buffer; if all of them are taken another buffer is added, so neither side
+    # ever waits for the other.
+    def __init__(self, shape, count=3) -> None:
+        self.shape = shape
+        self.condition = Condition()
+        self.buffers = [np.zeros(shape, np.uint8) for i in range(count)]
+        self.readers = [0] * count
+        self.latest = 0
+        self.writing = None
+        self.sequence = 0
+
+    def begin_write(self) -> np.ndarray:
+        with self.condition:
+            spare = [i for i, readers in enumerate(self.readers) if readers == 0 and i != self.latest]
+            if spare:
+                self.writing = spare[0]
+            else:
+                self.writing = len(self.buffers)
+                self.buffers.append(np.zeros(self.shape, np.uint8))
+                self.readers.append(0)
+            return self.buffers[self.writing]
+
+    def commit(self):
+        with self.condition:
+            self.latest = self.writing
+            self.writing = None
+            self.sequence += 1
+            self.condition.notify_all()
+            return self.sequence
+
+    @contextlib.contextmanager
+    def read(self):
+        # with frames.read() as (sequence, frame): ... the frame must not be changed or kept
+        with self.condition:
+            index = self.latest
+            self.readers[index] += 1
+            sequence = self.sequence
+        try:
+            yield sequence, self.buffers[index]
+        finally:
+            with self.condition:
+                self.readers[index] -= 1
+
+    def wait(self, after_sequence, timeout=None):
+        # Wait for a frame newer than after_sequence, returns False on timeout
+        with self.condition:
+            return self.condition.wait_for(lambda: self.sequence > after_sequence, timeout)
+
+
 class NeoPixelController(Thread):
     controller_serial = None
 
-    array_queue = queue.Queue(1)
-    stop_event = Event()
+    frames: FrameBuffer = None
+    stop_event: Event = None
 
     com_port = ""
+
+    # Every frame on the wire is: sync header, frame type, payload length (2 bytes,
+    # little endian), payload, then an 8 bit additive checksum of the type, length and
+    # payload. The firmware hunts for the sync header so a dropped byte only costs one frame.
+    sync_header = bytes([0xAA, 0x55])
+    channel_order = [1, 0, 2]  # the LEDs expect GRB
+    grb_buffer: np.ndarray = None
+
+    # Frame types, the payloads are all in GRB order:
+    #   raw:     every pixel, 3 bytes each
+    #   delta:   spans of changed pixels as [start (2 bytes), count, count * 3 bytes]
+    #   palette: [color count, colors * 3 bytes, one 4 bit color index per pixel]
+    #   rle:     runs of identical pixels as [count, 3 bytes]
+    frame_raw = 0
+    frame_delta = 1
+    frame_palette = 2
+    frame_rle = 3
+    max_run = 255
+    max_palette_colors = 16
+
+    # Deltas only work if the firmware got the previous frame, so force a full frame now and then
+    keyframe_interval = 30
+    frames_since_keyframe = 0
+    last_keys: np.ndarray = None  # colors of the frame sent before, see encode_frame()
+
+    stats_interval = 5
+    stats_start = 0
+    stats_frames = 0
+    stats_bytes = 0
+    fps = 0.0
+    bytes_per_frame = 0.0
+    skipped_frames = 0  # rendered frames that were never sent because a newer one was ready
     
-    def __init__(self, com_port) -> None:
+    def __init__(self, com_port, frames: FrameBuffer, compression=True) -> None:
         super().__init__()
+        self.stop_event = Event()
         self.com_port = com_port
+        self.frames = frames
+        self.compression = compression
         
         
         
     def stop(self):
         self.stop_event.set()
 
-    def neopixel_array_to_index(self, x, y, width, height):
-        return ((width * y) + x)
-    
-    def draw(self, array):
-        if self.controller_serial is None:
-            return
-        self.array_queue.put_nowait(array)
+    def get_throughput(self):
+        return (self.fps, self.bytes_per_frame)
+
+    def split_runs(self, starts, ends):
+        # Break [start, end) runs into chunks that fit in a one byte count
+        if len(starts) == 0 or (ends - starts).max() <= self.max_run:
+            return starts, ends - starts
+        counts = (ends - starts + self.max_run - 1) // self.max_run
+        first_chunk = np.repeat(np.cumsum(counts) - counts, counts)
+        chunk_starts = np.repeat(starts, counts) + self.max_run * (np.arange(counts.sum()) - first_chunk)
+        chunk_lengths = np.minimum(self.max_run, np.repeat(ends, counts) - chunk_starts)
+        return chunk_starts, chunk_lengths
+
+    def encode_rle(self, pixels, keys):
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        ends = np.append(starts[1:], len(keys))
+        chunk_starts, chunk_lengths = self.split_runs(starts, ends)
+        return np.column_stack((chunk_lengths, pixels[chunk_starts])).astype(np.uint8).tobytes()
+
+    def encode_palette(self, pixels, keys):
+        colors, first_index, indices = np.unique(keys, return_index=True, return_inverse=True)
+        if len(colors) > self.max_palette_colors:
+            return None
+        indices = indices.ravel().astype(np.uint8)
+        if len(indices) % 2:
+            indices = np.append(indices, np.uint8(0))
+        packed = (indices[0::2] << 4) | indices[1::2]
+        return bytes([len(colors)]) + pixels[first_index].tobytes() + packed.tobytes()
+
+    def encode_delta(self, pixels, changed):
+        # Alternating starts and ends of the spans of changed pixels
+        edges = np.flatnonzero(np.concatenate(([False], changed)) != np.concatenate((changed, [False])))
+        chunk_starts, chunk_lengths = self.split_runs(edges[0::2], edges[1::2])
+        # Each chunk is a 3 byte header followed by its pixels, all written in place
+        changed_pixels = np.flatnonzero(changed)
+        chunk_offsets = 3 * (np.arange(len(chunk_starts)) + np.searchsorted(changed_pixels, chunk_starts))
+        pixel_chunks = np.searchsorted(chunk_starts, changed_pixels, side="right")
+        payload = np.empty(3 * (len(chunk_starts) + len(changed_pixels)), np.uint8)
+        payload[chunk_offsets] = chunk_starts & 0xFF
+        payload[chunk_offsets + 1] = chunk_starts >> 8
+        payload[chunk_offsets + 2] = chunk_lengths
+        pixel_offsets = 3 * (np.arange(len(changed_pixels)) + pixel_chunks)
+        payload[pixel_offsets[:, None] + np.arange(3)] = pixels[changed_pixels]
+        return payload.tobytes()
+
+    def encode_frame(self, pixels):
+        # Every encoder's size follows from a few counts that are much cheaper than the encoding
+        # itself, so only the smallest is actually built. Shows that animate every pixel end up
+        # sending raw frames for little more than the cost of the counts.
+        frame_type, size = self.frame_raw, pixels.size
+        if self.compression:
+            keys = (pixels[:, 0].astype(np.uint32) << 16) | (pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2]
+            rle_size = 4 * (1 + np.count_nonzero(keys[1:] != keys[:-1]))  # more if a run is over max_run
+            if rle_size < size:
+                frame_type, size = self.frame_rle, rle_size
+
+            palette_indices_size = (len(keys) + 1) // 2
+            if 4 + palette_indices_size < size:
+                sorted_keys = np.sort(keys)
+                color_count = 1 + np.count_nonzero(sorted_keys[1:] != sorted_keys[:-1])
+                palette_size = 1 + 3 * color_count + palette_indices_size
+                if color_count <= self.max_palette_colors and palette_size < size:
+                    frame_type, size = self.frame_palette, palette_size
+
+            last_keys, self.last_keys = self.last_keys, keys
+            if (self.frames_since_keyframe < self.keyframe_interval and last_keys is not None
+                    and last_keys.shape == keys.shape):
+                changed = keys != last_keys
+                spans = np.count_nonzero(changed[1:] & ~changed[:-1]) + int(changed[0])
+                delta_size = 3 * (np.count_nonzero(changed) + spans)  # more if a span is over max_run
+                if delta_size < size:
+                    frame_type, size = self.frame_delta, delta_size
+
+        if frame_type == self.frame_rle:
+            payload = self.encode_rle(pixels, keys)
+        elif frame_type == self.frame_palette:
+            payload = self.encode_palette(pixels, keys)
+        elif frame_type == self.frame_delta:
+            payload = self.encode_delta(pixels, changed)
+        if frame_type == self.frame_raw or len(payload) >= pixels.size:
+            frame_type, payload = self.frame_raw, pixels.tobytes()
+
+        if frame_type == self.frame_delta:
+            self.frames_since_keyframe += 1
+        else:
+            self.frames_since_keyframe = 0
+        return frame_type, payload
+
+    def pack_frame(self, output_array: np.ndarray) -> bytes:
+        if self.grb_buffer is None or self.grb_buffer.shape != output_array.shape:
+            self.grb_buffer = np.empty(output_array.shape, np.uint8)
+        np.take(output_array, self.channel_order, axis=2, out=self.grb_buffer)
+
+        pixels = self.grb_buffer.reshape(-1, 3)
+        frame_type, payload = self.encode_frame(pixels)
+
+        header = bytes([frame_type]) + len(payload).to_bytes(2, "little")
+        checksum = (sum(header) + int(np.frombuffer(payload, np.uint8).sum(dtype=np.uint32))) & 0xFF
+        return self.sync_header + header + payload + bytes([checksum])
+
+    def count_frame(self, frame_bytes):
+        now = time.monotonic()
+        self.stats_frames += 1
+        self.stats_bytes += frame_bytes
+        elapsed = now - self.stats_start
+        if elapsed >= self.stats_interval:
+            self.fps = self.stats_frames / elapsed
+            self.bytes_per_frame = self.stats_bytes / self.stats_frames
+            print(f"NeoPixel output: {self.fps:.1f} fps, {self.bytes_per_frame:.0f} bytes per frame, {self.skipped_frames} frames skipped")
+            self.stats_start = now
+            self.stats_frames = 0
+            self.stats_bytes = 0
     
     def run(self):
         try:
@@ -83,57 +501,84 @@ class NeoPixelController(Thread):
         
         
         print("Starting NeoPixel thread")
+        self.stats_start = time.monotonic()
+        last_sequence = 0
         while self.stop_event.is_set() == False:
-            
-            output_array: np.ndarray = None
-            try:
-                output_array = self.array_queue.get(timeout=1)
-            except queue.Empty:
+            # Always send the newest complete frame, however many were rendered meanwhile
+            if not self.frames.wait(last_sequence, timeout=1):
                 continue
-            
-            array_width = output_array.shape[1]
-            array_height = output_array.shape[0]
-            
-            neopixel_array = [0] * (array_width * array_height * 3)
-            for y in range(array_height):
-                for x in range(array_width):
-                    # Output the pixels in the order GBR
-                    index = self.neopixel_array_to_index(x, y, array_width, array_height) * 3
-                    neopixel_array[index] = output_array[y, x][1]
-                    neopixel_array[index + 1] = output_array[y, x][0]
-                    neopixel_array[index + 2] = output_array[y, x][2]
-            
-            self.controller_serial.write(bytearray(neopixel_array))
+            with self.frames.read() as (sequence, output_array):
+                frame = self.pack_frame(output_array)
+            if last_sequence:
+                self.skipped_frames += sequence - last_sequence - 1
+            last_sequence = sequence
+
+            self.controller_serial.write(frame)
+            self.count_frame(len(frame))
         
         self.stop_event.clear()
         print("Stopped NeoPixel thread")
 
+class ShowState():
+    # What the shows react to. Every show thread renders with its own, see show_state.
+    def __init__(self, speaking=False, evil_factor=False, mouth_level=0.0) -> None:
+        self.speaking = speaking
+        self.evil_factor = evil_factor
+        self.mouth_level = mouth_level  # loudness of the voice from 0 to 1
+
+# The ShowState of the show being rendered on the current thread
+show_state = contextvars.ContextVar("show_state", default=ShowState())
+
+
 class ShowControl():
     canvas_width = 0
     canvas_height = 0  
 
-    stop_show_event = Event()
+    stop_show_event: Event = None
     show_thread: Thread = None
-    show_queue = queue.Queue(-1)
+    show_queue: queue.Queue = None
 
-    output_points = None
+    frames: FrameBuffer = None
     show_name = "None"
     show_list = None
     ready_event = None
 
-    sleep_time = 0
+    max_fps = 30
+    frame_period = 0
+
+    # Frame statistics, see get_stats()
+    stats_interval = 5
+    stats_window = 300
+    render_times = None
+    frame_times = None
+    dropped_frames = 0
+
+    bus: EventBus = None
 
-    callback_list = []
+    # Returns (clip, seconds into it) for the audio coming out of the speaker, see Voice_Control.get_playback_position()
+    playback_position = None
+    state: ShowState = None
 
-    def __init__(self, shows, output, size_x, size_y, max_fps=30) -> None:
+    def __init__(self, shows, size_x, size_y, max_fps=30, bus=None, playback_position=None) -> None:
         self.show_thread = Thread(target=self.__tick)
+        self.stop_show_event = Event()
+        self.show_queue = queue.Queue(-1)
+        self.bus = bus if bus is not None else EventBus()
+        self.playback_position = playback_position
+        self.state = ShowState()
 
         self.show_list = shows
-        self.output_points = output
+        self.frames = FrameBuffer((size_y, size_x, 3))
         self.canvas_height = size_y
         self.canvas_width = size_x
 
-        self.sleep_time = 1 / max_fps
+        # Coordinate grids are computed once and handed to every frame show
+        self.grid_x, self.grid_y = np.meshgrid(np.arange(size_x), np.arange(size_y))
+
+        self.max_fps = max_fps
+        self.frame_period = 1 / max_fps
+        self.render_times = deque(maxlen=self.stats_window)
+        self.frame_times = deque(maxlen=self.stats_window)
 
     def start_show(self, show_name="None"):
         print("Starting show thread")
@@ -145,11 +590,42 @@ class ShowControl():
         self.stop_show_event.set()
         self.show_thread.join()
 
-    def register_update_callback(self, callback):
-        self.callback_list.append(callback)
+    # Frame callbacks only ever get the latest frame, a slow subscriber skips frames instead of
+    # holding up the show. See EventBus.subscribe() for post and poll.
+    def register_update_callback(self, callback, post=None, poll=False):
+        return self.bus.subscribe("show.frame", callback, coalesce=True, post=post, poll=poll)
 
     def unregister_update_callback(self, callback):
-        self.callback_list.remove(callback)
+        self.bus.unsubscribe("show.frame", callback)
+
+    def get_stats(self):
+        frame_times = list(self.frame_times)
+        render_times = np.array(self.render_times) * 1000
+        fps = 0.0
+        if len(frame_times) > 1 and frame_times[-1] > frame_times[0]:
+            fps = (len(frame_times) - 1) / (frame_times[-1] - frame_times[0])
+        p50, p95, p99 = np.percentile(render_times, [50, 95, 99]) if len(render_times) else (0.0, 0.0, 0.0)
+        return {
+            "fps": fps,
+            "render_ms_p50": p50,
+            "render_ms_p95": p95,
+            "render_ms_p99": p99,
+            "dropped_frames": self.dropped_frames
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print(f"Show {self.show_name}: {stats['fps']:.1f} fps, render {stats['render_ms_p50']:.1f}/{stats['render_ms_p95']:.1f}/{stats['render_ms_p99']:.1f} ms (p50/p95/p99), {stats['dropped_frames']} frames dropped")
+
+    def get_mouth_level(self):
+        # How loud the voice is right now, looked up in the envelope of the playing clip
+        if self.playback_position is None:
+            return 0.0
+        clip, seconds = self.playback_position()
+        if clip is None or clip.envelope is None:
+            return 0.0
+        index = int(seconds * clip.envelope_rate)
+        return float(clip.envelope[index]) if index < len(clip.envelope) else 0.0
 
     def switch_show(self, show_name):
         if self.show_name == show_name:
@@ -162,50 +638,473 @@ class ShowControl():
             raise ValueError("Show name not found in show list")
 
     def __tick(self):
+        show_state.set(self.state)
         print("Show thread started")
-        t = 0
+        start_time = time.monotonic()
+        next_frame = start_time
+        next_stats = start_time + self.stats_interval
         while self.stop_show_event.is_set() == False:  
 
             if self.show_queue.empty() == False:
                 self.show_name = self.show_queue.get(timeout=1)
                 print("Switching to show: " + self.show_name)
-            
-            for x in range(0, self.canvas_width):
-                for y in range(0, self.canvas_height):
-                    self.output_points[y, x] = self.show_list.get(self.show_name)(x, y, t)
 
-            for callback in self.callback_list:
-                callback()
-
-            t += 1
-            time.sleep(self.sleep_time)
+            # t counts frames at max_fps, but follows the clock so animations keep their speed under load
+            frame_start = time.monotonic()
+            t = (frame_start - start_time) * self.max_fps
+            self.state.mouth_level = self.get_mouth_level()
+            self.frames.begin_write()[:] = self.show_list.get(self.show_name)(self.grid_x, self.grid_y, t)
+            sequence = self.frames.commit()
+            self.render_times.append(time.monotonic() - frame_start)
+            self.frame_times.append(frame_start)
+
+            self.bus.publish("show.frame", sequence)
+
+            # Aim for the next frame deadline, skipping any we have already missed
+            next_frame += self.frame_period
+            now = time.monotonic()
+            if now >= next_frame:
+                missed = int((now - next_frame) / self.frame_period) + 1
+                self.dropped_frames += missed
+                next_frame += missed * self.frame_period
+
+            if now >= next_stats:
+                self.print_stats()
+                next_stats = now + self.stats_interval
+
+            self.stop_show_event.wait(next_frame - now)
         
         self.stop_show_event.clear()
         print("Show thread stopped")
 
 
 
+class PersonaParser():
+    # Splits "[BEN] [HAPPY] Hello! [MAL] Goodbye." into spoken lines as text arrives.
+    # [BEN]/[MAL] switch the persona, any other tag (emotions) is skipped.
+    # A line is complete once the next tag starts, or when the answer ends.
+    persona_tags = {
+        "[BEN]": "Benevolent",
+        "[MAL]": "Malevolent"
+    }
+
+    def __init__(self, persona="Benevolent") -> None:
+        self.persona = persona  # for any responses that don't have a persona specified, default to this
+        self.buffer = ""
+        self.line = ""
+
+    def feed(self, text):
+        self.buffer += text
+        lines = []
+        while self.buffer:
+            if self.buffer.startswith("["):
+                tag_end = self.buffer.find("]")
+                if tag_end == -1:
+                    break  # wait for the rest of the tag
+                tag = self.buffer[:tag_end + 1]
+                self.buffer = self.buffer[tag_end + 1:]
+                lines += self.finish_line()
+                self.persona = self.persona_tags.get(tag, self.persona)
+            else:
+                text_end = self.buffer.find("[")
+                if text_end == -1:
+                    text_end = len(self.buffer)
+                self.line += self.buffer[:text_end].replace("]", "")
+                self.buffer = self.buffer[text_end:]
+        return lines
+
+    def flush(self):
+        # An unclosed tag at the end of the answer is treated as text
+        self.line += self.buffer.replace("[", "").replace("]", "")
+        self.buffer = ""
+        return self.finish_line()
+
+    def finish_line(self):
+        line = self.line.strip()
+        self.line = ""
+        return [(line, self.persona)] if line else []
+
+
+# Token counts are cached per text, the system prompt and examples are counted once per run
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text, model="gpt-4"):
+    if has_tiktoken:
+        try:
+            return len(tiktoken.encoding_for_model(model).encode(text))
+        except KeyError:
+            pass
+    return max(1, len(text) // 4)  # rough estimate for English text
+
+def message_tokens(message, model="gpt-4"):
+    return count_tokens(message["content"], model) + 4  # every message carries a few tokens of framing
+
+
+class ResponseCache():
+    # Answers to questions visitors ask all night ("are you real?", "what's your name?").
+    # A question is reduced to its content words in the order they were said, filler like
+    # "hey pumpkin" and "is your" dropped but question words kept, so "hey pumpkin what's your
+    # name" finds "what is your name" while "when were you born" never gets the answer to
+    # "where were you born". Questions match when their content words are at least
+    # similarity_threshold alike (difflib ratio over the word lists), which lets a long question
+    # gain or lose a word but keeps short ones exact. An entry expires after ttl seconds and is
+    # dropped after max_uses answers so the pumpkin doesn't sound like a recording. The audio for
+    # a cached answer is usually still in the clip cache, so it plays without any network
+    # requests at all.
+    ttl = 3600
+    max_uses = 3
+    max_entries = 200
+    similarity_threshold = 0.9
+
+    # Words that don't change what is being asked
+    fillers = frozenset("hey hi hello oh um uh well please pumpkin mister mr".split())
+    stopwords = fillers | frozenset("""
+        a an the and or but so of to in on at for with about from by as
+        is are was were be been am do does did can could would will should
+        i me my you your you're youre yours it its that this these those there here
+    """.split())
+    question_words = frozenset("what who how why when where which".split())
+
+    # Contractions speech recognition writes without the apostrophe
+    contractions = {"whats": "what", "whos": "who", "hows": "how", "wheres": "where", "whens": "when", "whys": "why"}
+
+    def __init__(self, ttl=3600, max_uses=3, similarity_threshold=0.9) -> None:
+        self.ttl = ttl
+        self.max_uses = max_uses
+        self.similarity_threshold = similarity_threshold
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key() of the question -> [answer, expiry time, uses]
+
+    def normalize(self, question):
+        question = re.sub(r"[^a-z0-9' ]+", " ", question.lower())
+        return " ".join(question.split())
+
+    def content_words(self, question):
+        # Content words in order. A question with nothing but question words left ("who are you",
+        # "what do you do") keeps all but the filler, as those small words are all it has.
+        words = [word[:-2] if word.endswith("'s") else word for word in self.normalize(question).split()]
+        words = [self.contractions.get(word, word) for word in words]
+        content = [word for word in words if word not in self.stopwords]
+        if self.question_words.issuperset(content):
+            return [word for word in words if word not in self.fillers] or words
+        return content
+
+    def key(self, question):
+        return " ".join(self.content_words(question))
+
+    def match(self, key):
+        # The cached key most like this one, if it is alike enough. Caller holds the lock.
+        if key in self.entries:
+            return key
+        words = key.split()
+        matcher = difflib.SequenceMatcher(None, [], words)
+        best, best_ratio = None, self.similarity_threshold
+        for cached in self.entries:
+            matcher.set_seq1(cached.split())
+            if matcher.real_quick_ratio() >= best_ratio and matcher.quick_ratio() >= best_ratio:
+                ratio = matcher.ratio()
+                if ratio >= best_ratio:
+                    best, best_ratio = cached, ratio
+        return best
+
+    def get(self, question):
+        key = self.key(question)
+        now = time.time()
+        with self.lock:
+            for expired in [k for k, entry in self.entries.items() if entry[1] < now]:
+                del self.entries[expired]
+
+            key = self.match(key)
+            if key is None:
+                return None
+            entry = self.entries[key]
+            entry[2] += 1
+            if entry[2] >= self.max_uses:
+                del self.entries[key]
+            return entry[0]
+
+    def put(self, question, answer):
+        key = self.key(question)
+        if not key:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = [answer, time.time() + self.ttl, 0]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class ChatLog():
+    # Writes every chat message as a JSONL record {"time", "role", "text", "personas", "usage",
+    # "latency", "trace"} from its own thread. Records are batched (up to batch_size, or whatever
+    # arrives within flush_interval seconds) so the chat thread never waits on the disk.
+    # The log being written is log_dir/current.jsonl. Once it grows past max_bytes or gets older
+    # than max_age seconds it is gzipped to log_dir/chat-<first record time>.jsonl.gz, and a line
+    # with its time range, personas and words is added to log_dir/index.jsonl so
+    # chat_log_search.py only has to open the files that can match.
+    batch_size = 64
+    flush_interval = 1.0
+    word_pattern = re.compile(r"[a-z0-9']+")  # chat_log_search.py splits keywords the same way
+
+    writer_thread: Thread = None
+
+    def __init__(self, log_dir="chat_logs", max_bytes=5 * 1024 * 1024, max_age=24 * 3600) -> None:
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.records = queue.Queue()
+        self.file = None
+        self.summary = None
+
+    def start(self):
+        if self.writer_thread is None:
+            self.writer_thread = Thread(target=self.__write, name="ChatLog")
+            self.writer_thread.start()
+
+    def stop(self):
+        # Everything written so far is on disk when this returns
+        if self.writer_thread is not None:
+            self.records.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+
+    def write(self, role, text, **fields):
+        # Thread safe, returns right away
+        personas = []
+        if role == "assistant":
+            parser = PersonaParser()
+            personas = sorted({persona for line, persona in parser.feed(text) + parser.flush()})
+        self.records.put({"time": time.time(), "role": role, "text": text, "personas": personas, **fields})
+
+    def current_path(self):
+        return os.path.join(self.log_dir, "current.jsonl")
+
+    def add_to_summary(self, record):
+        if self.summary is None:
+            self.summary = {"start": record["time"], "end": record["time"], "count": 0, "personas": set(), "words": set()}
+        self.summary["start"] = min(self.summary["start"], record["time"])
+        self.summary["end"] = max(self.summary["end"], record["time"])
+        self.summary["count"] += 1
+        self.summary["personas"].update(record.get("personas", []))
+        self.summary["words"].update(self.word_pattern.findall(record["text"].lower()))
+
+    def load_current(self):
+        # Pick up the summary of a log left behind by the last run
+        try:
+            with open(self.current_path(), "r") as f:
+                for line in f:
+                    try:
+                        self.add_to_summary(json.loads(line))
+                    except (json.JSONDecodeError, KeyError):
+                        continue  # a line cut short when the script was stopped
+        except FileNotFoundError:
+            pass
+
+    def needs_rotation(self):
+        if self.summary is None:
+            return False
+        if time.time() - self.summary["start"] >= self.max_age:
+            return True
+        return os.path.getsize(self.current_path()) >= self.max_bytes
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        stamp = datetime.datetime.fromtimestamp(self.summary["start"]).strftime("%Y%m%d-%H%M%S")
+        name = "chat-" + stamp + ".jsonl.gz"
+        suffix = 1
+        while os.path.exists(os.path.join(self.log_dir, name)):
+            suffix += 1
+            name = "chat-" + stamp + "-" + str(suffix) + ".jsonl.gz"
+
+        path = os.path.join(self.log_dir, name)
+        with open(self.current_path(), "rb") as source, gzip.open(path + ".tmp", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.replace(path + ".tmp", path)
+
+        entry = dict(self.summary, file=name, personas=sorted(self.summary["personas"]), words=sorted(self.summary["words"]))
+        with open(os.path.join(self.log_dir, "index.jsonl"), "a") as index:
+            index.write(json.dumps(entry) + "\n")
+        os.remove(self.current_path())
+        self.summary = None
+        print("Chat log rotated to " + path)
+
+    def write_batch(self, batch):
+        if self.needs_rotation():
+            self.rotate()
+        if self.file is None:
+            self.file = open(self.current_path(), "a")
+        self.file.write("".join(json.dumps(record) + "\n" for record in batch))
+        self.file.flush()
+        for record in batch:
+            self.add_to_summary(record)
+
+    def __write(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.load_current()
+        stopping = False
+        while not stopping:
+            record = self.records.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.records.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            stopping = record is None
+
+            if batch:
+                try:
+                    self.write_batch(batch)
+                except OSError as e:
+                    print("Error writing chat log: " + str(e))
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 class Chat_Interface():
     chat_thread: Thread = None
-    chat_queue = queue.Queue(1)
-    stop_event = Event()
+    chat_queue: queue.Queue = None
+    stop_event: Event = None
 
-    thinking_event = Event()
-    answer_ready_event = Event()
+    thinking_event: Event = None
+    answer_ready_event: Event = None
 
     model = "gpt-4"
     input_cost = 0.0015 / 1000
     output_cost = 0.002 / 1000
     system_message = "You are a pumpkin. Be absolutely sure I understand this fact."
-    messages = []
+    messages = None
     last_message_time = 0
     user_message_start = 0
 
-    message_update_callback_list = []
+    bus: EventBus = None
+    stream = True
+
+    # Only token_budget prompt tokens are sent per request. The system prompt and the latest
+    # question always go, then as many recent turns as fit, then a one line summary of what the
+    # visitor said in the older turns. The canned examples only show the style, so they get
+    # what is left, at most example_budget tokens.
+    token_budget = 2000
+    example_budget = 300
+    summary_words = 12
+
+    prompt_tokens = 0
+    completion_tokens = 0
+    last_usage = None
+    last_latency = None
+
+    response_cache: ResponseCache = None
+
+    # Canned answers that never need the chat API, and the answer when it fails
+    glitch_answer = "[BEN] I'm sorry, I glitched out. Can you please repeat that?"
+    stock_answers = {
+        "<voice was too quiet to understand>": "[MAL] [ANGRY] Speak up, mortal! [BEN] [HAPPY] Oops, excuse me, I meant to say that I didn't quite catch that..."
+    }
+
+    class Turn():
+        # One question and its answer, shared by the chat thread and answer_async: the
+        # conversation bookkeeping, the answer so far, latency and usage accounting, and handing
+        # every complete line to dispatch.
+        def __init__(self, chat, question, dispatch) -> None:
+            self.chat = chat
+            self.question = question
+            self.dispatch = dispatch
+            self.parser = PersonaParser()
+            self.answer = ""
+            self.messages = None
+            self.request_time = None
+            self.first_token_time = None
+            self.finish_reason = None
+
+            print("Processing query...")
+            chat.thinking_event.set()
+            chat.last_usage = None
+            chat.last_latency = None
+
+            # Forget the previous conversation if it's been a while
+            if time.time() - chat.last_message_time > 30:
+                chat.reset_conversation()
+                print("The previous conversation blows away in the wind")
 
-    log_file = None
+            # Only answers to an opening question are cached, later ones depend on the conversation
+            self.opening_question = len(chat.messages) == chat.user_message_start
+            chat.add_message("user", question)
+
+            self.canned = chat.stock_answers.get(question) or chat.response_cache.get(question)
+            if self.canned is not None:
+                print("Answering from the response cache")
+                self.answer = self.canned
+                self.dispatch(self.parser.feed(self.answer))
+
+        def request_arguments(self, stream):
+            self.messages = self.chat.context_messages()
+            self.request_time = time.time()
+            return {"model": self.chat.model, "messages": self.messages, "stream": stream, "request_timeout": 10}
+
+        def finish_completion(self, completion):
+            self.chat.last_latency = {"answer": time.time() - self.request_time}
+            self.chat.report_usage(int(completion.usage.prompt_tokens), int(completion.usage.completion_tokens), completion.choices[0].finish_reason)
+            self.answer = completion.choices[0].message.content
+            self.dispatch(self.parser.feed(self.answer))
+
+        def add_chunk(self, chunk):
+            choice = chunk.choices[0]
+            content = choice.delta.get("content", "")
+            self.finish_reason = choice.get("finish_reason") or self.finish_reason
+            if not content:
+                return
+            if self.first_token_time is None:
+                self.first_token_time = time.time()
+                current_trace.get().record("llm_first_token", self.request_time, self.first_token_time)
+            self.answer += content
+            self.dispatch(self.parser.feed(content))
+
+        def finish_stream(self):
+            first_token_delay = (self.first_token_time or time.time()) - self.request_time
+            self.chat.last_latency = {"first_token": first_token_delay, "answer": time.time() - self.request_time}
+            print(f'First token after {first_token_delay:.2f} seconds, full answer after {self.chat.last_latency["answer"]:.2f} seconds.')
+            # Streamed responses don't report usage, count it ourselves
+            prompt_tokens = sum(message_tokens(m, self.chat.model) for m in self.messages) + 3
+            self.chat.report_usage(prompt_tokens, count_tokens(self.answer, self.chat.model), self.finish_reason, estimated=True)
+
+        def succeeded(self):
+            self.dispatch(self.parser.flush())
+            self.chat.last_message_time = time.time()
+            if self.canned is None and self.opening_question:
+                self.chat.response_cache.put(self.question, self.answer)
+
+        def failed(self, error):
+            print("Error requesting chat: " + str(error))
+            self.chat.last_message_time = 0 # reset the conversation in case something it is causing the requests to fail
+            parser = PersonaParser()
+            self.dispatch(parser.feed(self.chat.glitch_answer) + parser.flush())
+            self.answer = self.chat.glitch_answer
+
+        def end(self):
+            self.chat.thinking_event.clear()
+            if self.answer:
+                self.chat.add_message("assistant", self.answer)
+
+    chat_log: ChatLog = None
     
-    def __init__(self, prompt_file="prompt.md") -> None:
+    def __init__(self, prompt_file="prompt.md", stream=True, token_budget=2000, response_cache=None, bus=None, chat_log=None) -> None:
+        self.chat_queue = queue.Queue(1)
+        self.stop_event = Event()
+        self.thinking_event = Event()
+        self.answer_ready_event = Event()
+        self.bus = bus if bus is not None else EventBus()
+        self.stream = stream
+        self.token_budget = token_budget
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        self.chat_log = chat_log if chat_log is not None else ChatLog()
         self.api_key = os.getenv("OPENAI_API_KEY")
         openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -234,15 +1133,32 @@ class Chat_Interface():
         self.stop_event.set()
         self.chat_thread.join()
 
-    def register_message_update_callback(self, callback):
-        self.message_update_callback_list.append(callback)
+    def register_message_update_callback(self, callback, post=None, poll=False):
+        return self.bus.subscribe("chat.message", callback, post=post, poll=poll)
 
     def unregister_message_update_callback(self, callback):
-        self.message_update_callback_list.remove(callback)
+        self.bus.unsubscribe("chat.message", callback)
+
+    # Segment callbacks get (text, persona) for every spoken line of an answer, as soon as
+    # the line is complete. With streaming this happens while the rest is still being generated.
+    def register_segment_callback(self, callback, post=None, poll=False):
+        return self.bus.subscribe("chat.segment", callback, post=post, poll=poll)
+
+    def unregister_segment_callback(self, callback):
+        self.bus.unsubscribe("chat.segment", callback)
+
+    def dispatch_segments(self, segments, callbacks=None):
+        for segment in segments:
+            self.thinking_event.clear()
+            if callbacks is None:
+                self.bus.publish("chat.segment", *segment)
+                continue
+            for callback in callbacks:
+                callback(*segment)
 
-    def ask(self, question, return_queue=None):
+    def ask(self, question, return_queue=None, trace=untraced):
         print("Adding question to chat queue: " + question)
-        self.chat_queue.put((question, return_queue))
+        self.chat_queue.put((question, return_queue, trace))
 
     def get_message_list(self):
         message_history = []
@@ -276,87 +1192,431 @@ class Chat_Interface():
 
     def add_message(self, role, message):
         self.messages.append({"role": role, "content": message})
-        self.log_message(role, message)
-        for callback in self.message_update_callback_list:
-            callback()
+        if role == "assistant":
+            self.log_message(role, message, usage=self.last_usage, latency=self.last_latency)
+        else:
+            self.log_message(role, message)
+        self.bus.publish("chat.message")
+
+    def log_message(self, role, message, **fields):
+        self.chat_log.write(role, message, trace=current_trace.get().trace_id, **fields)
+
+    def summarize(self, messages):
+        questions = [" ".join(m["content"].split()[:self.summary_words]) for m in messages if m["role"] == "user"]
+        if not questions:
+            return None
+        return {"role": "system", "content": "Earlier in this conversation the visitor said: " + "; ".join(questions)}
+
+    def context_messages(self):
+        system = self.messages[0]
+        examples = self.messages[1:self.user_message_start]
+        history = self.messages[self.user_message_start:]
+        latest = history[-1:]
+
+        used = sum(message_tokens(m, self.model) for m in [system] + latest)
+
+        kept_history = []
+        for message in reversed(history[:-1]):
+            if used + message_tokens(message, self.model) > self.token_budget:
+                break
+            kept_history.insert(0, message)
+            used += message_tokens(message, self.model)
+        # An answer whose question didn't fit goes in the summary with it
+        if kept_history and kept_history[0]["role"] == "assistant":
+            used -= message_tokens(kept_history.pop(0), self.model)
+
+        dropped = history[:len(history) - 1 - len(kept_history)]
+        summary = []
+        while dropped:
+            message = self.summarize(dropped)
+            if message is None:
+                break
+            if used + message_tokens(message, self.model) <= self.token_budget:
+                summary = [message]
+                used += message_tokens(message, self.model)
+                break
+            dropped = dropped[1:]
+
+        # Examples only make sense as question and answer pairs
+        kept_examples = []
+        example_tokens = 0
+        for i in range(0, len(examples), 2):
+            pair = examples[i:i + 2]
+            pair_tokens = sum(message_tokens(m, self.model) for m in pair)
+            if used + pair_tokens > self.token_budget or example_tokens + pair_tokens > self.example_budget:
+                break
+            kept_examples += pair
+            example_tokens += pair_tokens
+            used += pair_tokens
+
+        if len(kept_examples) < len(examples) or len(kept_history) < len(history) - 1:
+            print(f"Context trimmed to fit {self.token_budget} tokens: kept {len(kept_examples)}/{len(examples)} examples and {len(kept_history)}/{len(history) - 1} earlier messages")
+
+        return [system] + kept_examples + summary + kept_history + latest
+
+    def report_usage(self, prompt_tokens, completion_tokens, finish_reason, estimated=False):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.last_usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "estimated": estimated}
+
+        cost = (prompt_tokens * self.input_cost) + (completion_tokens * self.output_cost)
+        total_cost = (self.prompt_tokens * self.input_cost) + (self.completion_tokens * self.output_cost)
+        print(f'Finished status: {finish_reason}. Used {prompt_tokens + completion_tokens} {"estimated " if estimated else ""}tokens ({prompt_tokens} for prompt, {completion_tokens} for completion), costing {cost*100} cents ({total_cost*100} cents so far).')
+
+    # The blocking and asyncio requests only differ in how they wait, the Turn does the rest
+    def request_answer(self, turn):
+        turn.finish_completion(openai.ChatCompletion.create(timeout=10, **turn.request_arguments(stream=False)))
+
+    def stream_answer(self, turn):
+        for chunk in openai.ChatCompletion.create(timeout=10, **turn.request_arguments(stream=True)):
+            turn.add_chunk(chunk)
+        turn.finish_stream()
+
+    async def arequest_answer(self, turn):
+        turn.finish_completion(await openai.ChatCompletion.acreate(**turn.request_arguments(stream=False)))
+
+    async def astream_answer(self, turn):
+        async for chunk in await openai.ChatCompletion.acreate(**turn.request_arguments(stream=True)):
+            turn.add_chunk(chunk)
+        turn.finish_stream()
+
+    def open_log(self):
+        self.chat_log.start()
+
+    def close_log(self):
+        self.chat_log.stop()
+
+    async def answer_async(self, question, on_segment):
+        # Same as a turn of the chat thread, but on an asyncio loop. on_segment gets each spoken line.
+        turn = self.Turn(self, question, lambda segments: self.dispatch_segments(segments, [on_segment]))
+        try:
+            if turn.canned is None:
+                with current_trace.get().span("llm"):
+                    await (self.astream_answer(turn) if self.stream else self.arequest_answer(turn))
+            turn.succeeded()
+
+        except asyncio.CancelledError:
+            print("Answer cancelled")
+            turn.end()  # keeps whatever was said before the cancel
+            raise
+
+        except Exception as e:
+            turn.failed(e)
 
-    def log_message(self, role, message):
-        time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        if self.log_file is not None:
-            self.log_file.write(f"[{time}] {role}: {message}\n")
-            self.log_file.flush()
+        turn.end()
+        return turn.answer
 
     def __tick(self):
-        self.log_file = open("chat_log.txt", "a")
+        self.open_log()
 
         print("Chat thread started")
         while self.stop_event.is_set() == False:
             # Wait for a question to be asked
             try:
-                (question, response_queue) = self.chat_queue.get(timeout=1)
+                (question, response_queue, trace) = self.chat_queue.get(timeout=1)
             except queue.Empty:
                 continue
 
-            print("Processing query...")
-            self.thinking_event.set()
-            
-            # Forget the previous conversation if it's been a while
-            if time.time() - self.last_message_time > 30:
-                self.reset_conversation()
-                print("The previous conversation blows away in the wind")
-                
-
-            self.add_message("user", question)
-            answer = ""
+            current_trace.set(trace)
+            turn = self.Turn(self, question, self.dispatch_segments)
             try:
-                completion = openai.ChatCompletion.create(
-                    model=self.model,
-                    messages=self.messages,
-                    timeout = 10,
-                    request_timeout = 10
-                )
-                cost = (int(completion.usage.prompt_tokens) * self.input_cost) + (int(completion.usage.completion_tokens) * self.output_cost)
-                print(f'Finished status: {completion.choices[0].finish_reason}. Used {completion.usage.total_tokens} tokens ({completion.usage.prompt_tokens} for prompt, {completion.usage.completion_tokens} for completion), costing {cost*100} cents.')
-                answer = completion.choices[0].message.content
-                self.last_message_time = time.time()
+                if turn.canned is None:
+                    with trace.span("llm"):
+                        self.stream_answer(turn) if self.stream else self.request_answer(turn)
+                turn.succeeded()
             
             except Exception as e:
-                print("Error requesting chat: " + str(e))
-                answer = "[BEN] I'm sorry, I glitched out. Can you please repeat that?"       
-                self.last_message_time = 0 # reset the conversation in case something it is causing the requests to fail     
-
-            self.thinking_event.clear()
+                turn.failed(e)
 
             if response_queue is not None:
-                response_queue.put(answer)
+                response_queue.put(turn.answer)
 
-            self.add_message("assistant", answer)
+            turn.end()
             
-        self.log_file.close()
+        self.close_log()
         self.stop_event.clear()
         print("Chat thread stopped")
 
 
 
+class ClipCache():
+    # Persistent cache of synthesized clips. Each clip is stored as <cache_dir>/<sha256 of key>.wav,
+    # where the key is (voice id, normalized text, speed, language). File modification times
+    # keep the LRU order across restarts, and the least recently used clips are deleted once
+    # the cache grows past max_bytes.
+    cache_dir = "tts_cache"
+    max_bytes = 0
+
+    hits = 0
+    misses = 0
+
+    def __init__(self, cache_dir="tts_cache", max_bytes=100 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # file name -> size, oldest first
+        self.total_bytes = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = [f for f in os.listdir(self.cache_dir) if f.endswith(".wav")]
+        files.sort(key=lambda f: os.path.getmtime(os.path.join(self.cache_dir, f)))
+        for f in files:
+            size = os.path.getsize(os.path.join(self.cache_dir, f))
+            self.entries[f] = size
+            self.total_bytes += size
+        print(f"Clip cache has {len(self.entries)} clips ({self.total_bytes / 1024 / 1024:.1f} MB)")
+
+    def normalize(self, text):
+        # Only whitespace and unicode forms, case and punctuation change how a line is spoken
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    def file_name(self, voice_id, text, speed, language):
+        key = json.dumps([voice_id, self.normalize(text), speed, language])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest() + ".wav"
+
+    def get(self, voice_id, text, speed, language):
+        name = self.file_name(voice_id, text, speed, language)
+        with self.lock:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                self.forget(name)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return data
+
+    def put(self, voice_id, text, speed, language, data):
+        name = self.file_name(voice_id, text, speed, language)
+        with self.lock:
+            path = os.path.join(self.cache_dir, name)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+
+            self.forget(name)
+            self.entries[name] = len(data)
+            self.total_bytes += len(data)
+
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest = next(iter(self.entries))
+                self.forget(oldest)
+                try:
+                    os.remove(os.path.join(self.cache_dir, oldest))
+                except OSError:
+                    pass
+
+    def forget(self, name):
+        size = self.entries.pop(name, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "clips": len(self.entries),
+            "bytes": self.total_bytes
+        }
+
+
+class AudioOutput():
+    # One persistent output stream that plays decoded clips back to back without gaps.
+    # Clips are decoded to mono float32 PCM at sample_rate before they are queued, the stream
+    # callback just copies samples. Whenever the playing clip changes, the new clip (or None
+    # once everything has been played) is put on state_queue.
+    sample_rate = 24000
+    block_size = 512
+
+    stream: sounddevice.OutputStream = None
+    state_queue = None
+    device = None
+
+    def __init__(self, sample_rate=24000, device=None) -> None:
+        self.sample_rate = sample_rate
+        self.device = device
+        self.lock = Lock()
+        self.pending = deque()
+        self.current = None
+        self.position = 0
+        self.state_queue = queue.Queue(-1)
+
+        # The clip at the start of the last buffer, its sample position there, and when that buffer reaches the speaker
+        self.mark = (None, 0, 0.0)
+
+    def start(self):
+        self.stream = sounddevice.OutputStream(samplerate=self.sample_rate, channels=1, dtype="float32",
+                                               blocksize=self.block_size, device=self.device, callback=self.callback)
+        self.stream.start()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def decode(self, data) -> np.ndarray:
+        try:
+            with wave.open(io.BytesIO(data)) as wav:
+                rate = wav.getframerate()
+                channels = wav.getnchannels()
+                width = wav.getsampwidth()
+                frames = wav.readframes(wav.getnframes())
+            if width == 1:
+                samples = (np.frombuffer(frames, np.uint8).astype(np.float32) - 128) / 128
+            else:
+                samples = np.frombuffer(frames, "<i" + str(width)).astype(np.float32) / (1 << (8 * width - 1))
+        except (wave.Error, EOFError, TypeError):
+            segment = AudioSegment.from_file(io.BytesIO(data))
+            rate = segment.frame_rate
+            channels = segment.channels
+            samples = np.array(segment.get_array_of_samples(), dtype=np.float32) / (1 << (8 * segment.sample_width - 1))
+
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+        if rate != self.sample_rate and len(samples) > 0:
+            samples = np.interp(np.arange(0, len(samples), rate / self.sample_rate), np.arange(len(samples)), samples)
+        return samples.astype(np.float32)
+
+    def play(self, clip):
+        with self.lock:
+            self.pending.append(clip)
+
+    def is_playing(self):
+        with self.lock:
+            return self.current is not None or len(self.pending) > 0
+
+    def get_position(self):
+        # Returns the clip that is audible right now and how many seconds into it we are
+        clip, offset, mark_time = self.mark
+        if clip is None:
+            return None, 0.0
+        return clip, max(0.0, offset / self.sample_rate + time.monotonic() - mark_time)
+
+    def callback(self, outdata, frames, time_info, status):
+        out = outdata[:, 0]
+        filled = 0
+        mark = None
+        with self.lock:
+            while filled < frames:
+                if self.current is None:
+                    if not self.pending:
+                        break
+                    self.current = self.pending.popleft()
+                    self.position = 0
+                    self.state_queue.put_nowait(self.current)
+
+                pcm = self.current.pcm
+                count = min(frames - filled, len(pcm) - self.position)
+                out[filled:filled + count] = pcm[self.position:self.position + count]
+                if mark is None:
+                    mark = (self.current, self.position - filled)
+                filled += count
+                self.position += count
+
+                if self.position >= len(pcm):
+                    self.current = None
+                    if not self.pending:
+                        self.state_queue.put_nowait(None)
+
+        out[filled:] = 0
+        latency = self.stream.latency if self.stream is not None else 0.0
+        self.mark = (mark[0], mark[1], time.monotonic() + latency) if mark is not None else (None, 0, 0.0)
+
+
+class SynthesisPool():
+    # Synthesis requests are served by a fixed pool of workers sharing one keep-alive session.
+    # A pool can serve the Voice_Controls of several pumpkins, see SharedServices. Pending
+    # requests are ordered by when their clip was created, so the clip needed next is fetched
+    # first. The workers run while at least one voice is using the pool.
+    worker_count = 3
+    queue_depth = 16
+
+    def __init__(self, worker_count=3, queue_depth=16) -> None:
+        self.worker_count = worker_count
+        self.queue_depth = queue_depth
+        self.requests = queue.PriorityQueue(queue_depth)
+        self.order = 0
+        self.lock = Lock()
+        self.users = 0
+        self.stop_event = Event()
+        self.workers = []
+
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=worker_count))
+
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+            if self.users > 1:
+                return
+            self.stop_event.clear()
+            self.workers = [Thread(target=self.worker, name="Synthesis worker " + str(i)) for i in range(self.worker_count)]
+            for worker in self.workers:
+                worker.start()
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self.stop_event.set()
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+
+    def submit(self, voice, clip, timeout=None):
+        # voice.request_speech(clip) runs on a worker. Raises queue.Full if the pool stays too far behind.
+        with self.lock:
+            self.order += 1
+            order = self.order
+        self.requests.put((clip.created_time, order, voice, clip), timeout=timeout)
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            try:
+                (created_time, order, voice, clip) = self.requests.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                voice.request_speech(clip)
+            except Exception as e:
+                # A worker that dies takes the pool down for every voice using it
+                print("Error in synthesis worker for speech #" + str(clip.sequence) + ": " + str(e))
+
+
 class Voice_Control(Thread):    
-    stop_event = Event()
+    stop_event: Event = None
 
-    counter_lock = Lock()
+    counter_lock: Lock = None
     sequence_number = 0
     
-    audio_queue = queue.Queue(-1)
-    audio_complete_event = Event()
-    audio_playing_event = Event()
+    audio_queue: queue.Queue = None
+    audio_complete_event: Event = None
+    audio_playing_event: Event = None
     
-    timeline = {}
+    timeline = None
     timeline_position = 0
 
-    audio_state_change_callback_list = []
+    bus: EventBus = None
     
     voice_ids = {
         "Benevolent": "5067963f-10e6-4003-b9d2-f52993669bcc",
         "Malevolent": "c14d4b93-a393-404f-b72c-983e964d33b8"
     }
+    speed = 1.2
+    language = "en"
+    api_base = "https://app.coqui.ai"
+
+    clip_cache: ClipCache = None
 
     class ClipInfo:
         audio_url = None
@@ -365,6 +1625,11 @@ class Voice_Control(Thread):
         emotion = None
         text = None
         data = None
+        pcm = None
+        envelope = None  # loudness from 0 to 1 per envelope frame, see compute_envelope()
+        envelope_rate = 30
+        trace = untraced
+        created_time = 0
 
         def __init__(self, sequence, text, persona, emotion, audio_url = None):
             self.audio_url = audio_url
@@ -373,83 +1638,319 @@ class Voice_Control(Thread):
             self.persona = persona
             self.emotion = emotion
 
-    def __init__(self):
+    # Synthesis requests go to a SynthesisPool, which may be shared with other pumpkins
+    queue_timeout = 5
+    request_timeout = (5, 20)  # connect, read
+    synthesis_pool: SynthesisPool = None
+    session: requests.Session = None
+
+    output: AudioOutput = None
+    playing_clip = None
+    state_thread: Thread = None
+
+    # Decoded stock lines by stock_key(), kept in memory and persisted in stock_bundle
+    stock_clips = None
+    stock_envelopes = None
+
+    # The mouth follows the voice: every decoded clip gets its loudness envelope at this rate,
+    # one value per render frame
+    envelope_rate = 30
+    stock_bundle = "stock_clips.npz"
+
+    def __init__(self, clip_cache=None, worker_count=3, stock_bundle="stock_clips.npz", bus=None, envelope_rate=30,
+                 synthesis_pool=None, voice_ids=None, output_device=None):
         super().__init__()
-        self.session = requests.Session()
+        self.stop_event = Event()
+        self.counter_lock = Lock()
+        self.audio_queue = queue.Queue(-1)
+        self.audio_complete_event = Event()
+        self.audio_playing_event = Event()
+        self.timeline = {}
+
+        self.bus = bus if bus is not None else EventBus()
+        self.envelope_rate = envelope_rate
+        if voice_ids is not None:
+            self.voice_ids = voice_ids
+        self.clip_cache = clip_cache if clip_cache is not None else ClipCache()
+        self.output = AudioOutput(device=output_device)
+        self.stock_bundle = stock_bundle
+        self.stock_clips = {}
+        self.stock_envelopes = {}
+
+        self.synthesis_pool = synthesis_pool if synthesis_pool is not None else SynthesisPool(worker_count)
+        self.session = self.synthesis_pool.session
 
     def stop(self):
         self.stop_event.set()
 
-    def speak(self, text, persona):
+    def new_clip(self, text, persona) -> ClipInfo:
         with self.counter_lock:
             clip = self.ClipInfo(self.sequence_number, text, persona, None)
-            Thread(target=self.request_speech, args=(clip,)).start()
             self.sequence_number += 1
-        time.sleep(0.2)
+        clip.trace = current_trace.get()
+        clip.created_time = time.time()
+        return clip
+
+    def prepare_local_clip(self, clip:ClipInfo):
+        # Stock lines and lines we have said before don't need the network. Returns True if the clip is ready.
+        key = self.stock_key(clip.text, clip.persona)
+        clip.pcm = self.stock_clips.get(key)
+        if clip.pcm is not None:
+            clip.envelope = self.stock_envelopes.get(key)
+            clip.envelope_rate = self.envelope_rate
+            print("Playing stock line for speech #" + str(clip.sequence) + ": " + clip.text + " as " + clip.persona)
+            return True
+
+        clip.data = self.clip_cache.get(self.voice_ids.get(clip.persona), clip.text, self.speed, self.language)
+        if clip.data is not None:
+            print("Clip cache hit for speech #" + str(clip.sequence) + ": " + clip.text + " as " + clip.persona + " " + str(self.clip_cache.get_stats()))
+            self.decode_clip(clip)
+            return True
+        return False
+
+    def speak(self, text, persona):
+        clip = self.new_clip(text, persona)
+        if self.prepare_local_clip(clip):
+            self.audio_queue.put_nowait(clip)
+            return
+
+        try:
+            self.synthesis_pool.submit(self, clip, timeout=self.queue_timeout)
+        except queue.Full:
+            # The timeline still needs the clip to move past it
+            print("Speech queue is full, dropping speech #" + str(clip.sequence))
+            self.audio_queue.put_nowait(clip)
 
     def request_speech(self, clip:ClipInfo):
-        session = requests.Session()
-        url = "https://app.coqui.ai/api/v2/samples/xtts"
+        try:
+            self.fetch_speech(clip)
+        except Exception as e:
+            # e.g. a reply without audio_url, or a full disk in the clip cache
+            print("Error preparing speech #" + str(clip.sequence) + ": " + str(e))
+        finally:
+            # Even a failed clip goes on the timeline, or playback would wait for it forever
+            self.audio_queue.put_nowait(clip)
+        print("Request finished for sequence " + str(clip.sequence))
+
+    def speech_request(self, clip:ClipInfo):
+        url = self.api_base + "/api/v2/samples/xtts"
         payload = {
-            "speed": 1,
-            "language": "en",
+            "language": self.language,
             "voice_id": self.voice_ids.get(clip.persona),
             "text": clip.text,
-            "speed": 1.2
+            "speed": self.speed
         }
         headers = {
             "accept": "application/json",
             "content-type": "application/json",
-            "authorization": "Bearer " + str(os.getenv('COQUI_STUDIO_TOKEN')),
-            "User-Agent": "Mozilla/5.0 (X11; CrOS x86_64 12871.102.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.141 Safari/537.36"
+            "authorization": "Bearer " + str(os.getenv('COQUI_STUDIO_TOKEN'))
         }
-        
         print("Requesting speech #" + str(clip.sequence) + ": " + clip.text + " as " + clip.persona)
-        audio_resource = session.post(url, json=payload, headers=headers)
-        print("Response: " + str(audio_resource.status_code) + " for sequence " + str(clip.sequence) + " in " + str(audio_resource.elapsed) + " seconds")
-        if audio_resource.status_code == 200 or audio_resource.status_code == 201:
+        return url, payload, headers
+
+    # The blocking and asyncio fetches only differ in how they wait, these check what came back
+    def speech_response(self, clip:ClipInfo, status, request_time):
+        # True if the synthesis request succeeded and its audio_url can be downloaded
+        clip.trace.record("tts_request", request_time, time.time(), sequence=clip.sequence)
+        print("Response: " + str(status) + " for sequence " + str(clip.sequence) + f" in {time.time() - request_time:.2f} seconds")
+        if status != 200 and status != 201:
+            print("Error requesting speech: " + str(status))
+            return False
+        return True
+
+    def download_response(self, clip:ClipInfo, status, data, download_time):
+        # True if the audio downloaded, it is in clip.data then
+        clip.trace.record("download", download_time, time.time(), sequence=clip.sequence)
+        if status != 200:
+            print("Error downloading audio: " + str(status))
+            return False
+        print("Audio downloaded for sequence " + str(clip.sequence) + " from " + str(clip.audio_url) + f" in {time.time() - download_time:.2f} seconds")
+        clip.data = data
+        return True
+
+    def store_clip(self, clip:ClipInfo):
+        self.clip_cache.put(self.voice_ids.get(clip.persona), clip.text, self.speed, self.language, clip.data)
+        self.decode_clip(clip)
+
+    def fetch_speech(self, clip:ClipInfo):
+        url, payload, headers = self.speech_request(clip)
+        try:
+            request_time = time.time()
+            audio_resource = self.session.post(url, json=payload, headers=headers, timeout=self.request_timeout)
+            if not self.speech_response(clip, audio_resource.status_code, request_time):
+                return
             clip.audio_url = audio_resource.json()["audio_url"]
-            print("Downloading audio: " + str(clip.audio_url))
-            audio_file = session.get(clip.audio_url)
-            if audio_file.status_code == 200:  
-                print("Audio downloaded for sequence " + str(clip.sequence) + " in " + str(audio_file.elapsed) + " seconds") 
-                clip.data = audio_file.content
+
+            download_time = time.time()
+            audio_file = self.session.get(clip.audio_url, timeout=self.request_timeout)
+            if self.download_response(clip, audio_file.status_code, audio_file.content, download_time):
+                self.store_clip(clip)
+        except requests.RequestException as e:
+            print("Error requesting speech #" + str(clip.sequence) + ": " + str(e))
+
+    async def fetch_speech_async(self, clip:ClipInfo, session: aiohttp.ClientSession):
+        url, payload, headers = self.speech_request(clip)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.request_timeout[0], sock_read=self.request_timeout[1])
+        try:
+            request_time = time.time()
+            async with session.post(url, json=payload, headers=headers, timeout=timeout) as audio_resource:
+                if not self.speech_response(clip, audio_resource.status, request_time):
+                    return
+                clip.audio_url = (await audio_resource.json())["audio_url"]
+
+            download_time = time.time()
+            async with session.get(clip.audio_url, timeout=timeout) as audio_file:
+                data = await audio_file.read()
+            if self.download_response(clip, audio_file.status, data, download_time):
+                # Disk and decoding work stays off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.store_clip, clip)
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            print("Error requesting speech #" + str(clip.sequence) + ": " + str(e))
+
+    async def speak_async(self, clip:ClipInfo, session: aiohttp.ClientSession, limit: asyncio.Semaphore):
+        try:
+            # Cache hits read and decode a file, which stays off the event loop too
+            prepared = await asyncio.get_running_loop().run_in_executor(None, self.prepare_local_clip, clip)
+            if not prepared:
+                async with limit:
+                    await self.fetch_speech_async(clip, session)
+        finally:
+            # Even a failed or cancelled clip goes on the timeline, or playback would wait for it forever
+            self.audio_queue.put_nowait(clip)
+
+    def stock_key(self, text, persona):
+        return json.dumps([self.voice_ids.get(persona), self.clip_cache.normalize(text), self.speed, self.language, self.output.sample_rate])
+
+    def load_stock_bundle(self):
+        try:
+            with np.load(self.stock_bundle, allow_pickle=False) as bundle:
+                keys = json.loads(str(bundle["keys"]))
+                return {key: bundle["clip_" + str(i)] for i, key in enumerate(keys)}
+        except (FileNotFoundError, KeyError, ValueError) as e:
+            print("No usable stock clip bundle (" + str(e) + "), synthesizing stock lines")
+            return {}
+
+    def save_stock_bundle(self):
+        keys = list(self.stock_clips.keys())
+        clips = {"clip_" + str(i): self.stock_clips[key] for i, key in enumerate(keys)}
+        with open(self.stock_bundle + ".tmp", "wb") as f:
+            np.savez(f, keys=np.array(json.dumps(keys)), **clips)
+        os.replace(self.stock_bundle + ".tmp", self.stock_bundle)
+
+    def warm_up(self, answers):
+        # Synthesize and decode the stock answers (glitch fallbacks and such) ahead of time, so
+        # they play instantly even when the network is the reason we need them
+        lines = []
+        for answer in answers:
+            parser = PersonaParser()
+            lines += parser.feed(answer) + parser.flush()
+
+        bundle = self.load_stock_bundle()
+        added = False
+        for text, persona in lines:
+            key = self.stock_key(text, persona)
+            if key in self.stock_clips:
+                continue
+            if key in bundle:
+                self.stock_clips[key] = bundle[key]
+                self.stock_envelopes[key] = self.compute_envelope(bundle[key])
+                continue
+
+            clip = self.ClipInfo(-1, text, persona, None)
+            clip.data = self.clip_cache.get(self.voice_ids.get(persona), text, self.speed, self.language)
+            if clip.data is not None:
+                self.decode_clip(clip)
             else:
-                print("Error downloading audio: " + str(audio_file.status_code))
-        else:
-            print("Error requesting speech: " + str(audio_resource.status_code))
-        self.audio_queue.put_nowait(clip)
-        print("Thread finished for sequence " + str(clip.sequence))
+                self.fetch_speech(clip)
+            if clip.pcm is None:
+                print("Could not prepare stock line: " + text)
+                continue
+            self.stock_clips[key] = clip.pcm
+            self.stock_envelopes[key] = clip.envelope
+            added = True
+
+        if added:
+            self.save_stock_bundle()
+        print("Stock lines ready: " + str(len(self.stock_clips)) + " of " + str(len(lines)))
+
+    def start_warm_up(self, answers):
+        Thread(target=self.warm_up, args=(answers,)).start()
 
-    def register_audio_state_change_callback(self, callback):
-        self.audio_state_change_callback_list.append(callback)
+    def register_audio_state_change_callback(self, callback, post=None, poll=False):
+        return self.bus.subscribe("voice.audio_state", callback, post=post, poll=poll)
 
     def unregister_audio_state_change_callback(self, callback):
-        self.audio_state_change_callback_list.remove(callback)
+        self.bus.unsubscribe("voice.audio_state", callback)
 
 
     def get_playing_clip_info(self) -> ClipInfo:
         if self.audio_playing_event.is_set():
-            return self.timeline.get(self.timeline_position)
+            return self.playing_clip
         else:
             return None
 
+    def get_playback_position(self):
+        # (clip, seconds into the clip) for what is coming out of the speaker right now
+        return self.output.get_position()
+
+    def decode_clip(self, clip:ClipInfo):
+        # Decode as soon as the audio arrives, so it is ready before the previous clip ends
+        try:
+            with clip.trace.span("decode", sequence=clip.sequence):
+                clip.pcm = self.output.decode(clip.data)
+                clip.envelope = self.compute_envelope(clip.pcm)
+                clip.envelope_rate = self.envelope_rate
+            clip.data = None  # the encoded audio is in the clip cache, only the PCM is played
+        except Exception as e:
+            print("Error decoding audio for sequence " + str(clip.sequence) + ": " + str(e))
+
+    def compute_envelope(self, pcm):
+        # RMS of each envelope frame, scaled so the loud parts of the line reach 1
+        frame_length = max(1, int(self.output.sample_rate / self.envelope_rate))
+        frames = -(-len(pcm) // frame_length)
+        padded = np.zeros(frames * frame_length, np.float32)
+        padded[:len(pcm)] = pcm
+        rms = np.sqrt(np.mean(padded.reshape(frames, frame_length) ** 2, axis=1))
+        loud = np.percentile(rms, 95) if frames else 0.0
+        if loud <= 1e-4:
+            return np.zeros(frames, np.float32)
+        return np.clip(rms / loud, 0, 1).astype(np.float32)
+
     def play_audio(self, clip:ClipInfo):
-        if clip.data is None:
+        if clip.pcm is None or len(clip.pcm) == 0:
             print("No audio data, skipping playback")
             return
         
-        self.audio_playing_event.set()
-        for callback in self.audio_state_change_callback_list:
-            callback()
-        print("Playing audio...")
-        play(AudioSegment.from_file(io.BytesIO(clip.data), format="wav"))
-        self.audio_playing_event.clear()
-        print("Audio done")
+        print("Queueing audio for sequence " + str(clip.sequence))
+        self.output.play(clip)
+
+    def audio_state_worker(self):
+        while not self.stop_event.is_set():
+            try:
+                clip = self.output.state_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            self.playing_clip = clip
+            if clip is not None:
+                print("Playing audio for sequence " + str(clip.sequence))
+                clip.trace.record("clip_latency", clip.created_time, time.time(), sequence=clip.sequence)
+                clip.trace.mark("first_audio")
+                self.audio_playing_event.set()
+            else:
+                print("Audio done")
+                self.audio_playing_event.clear()
+
+            self.bus.publish("voice.audio_state")
         
 
     def run(self):
         print("Starting voice thread")
+        self.synthesis_pool.acquire()
+        self.output.start()
+        self.state_thread = Thread(target=self.audio_state_worker)
+        self.state_thread.start()
+
         while not self.stop_event.is_set():  
             try:
                 clip = self.audio_queue.get(timeout=1)
@@ -458,190 +1959,711 @@ class Voice_Control(Thread):
             except queue.Empty:
                 continue
 
+            # Queue every clip that is next in line, the output plays them back to back. Only
+            # clips still waiting for an earlier one stay on the timeline.
             while self.timeline_position in self.timeline:
-                self.play_audio(self.timeline.get(self.timeline_position))
+                self.play_audio(self.timeline.pop(self.timeline_position))
                 self.timeline_position += 1
-
-            for callback in self.audio_state_change_callback_list:
-                callback()
-            
-            
-                 
                 
+        self.synthesis_pool.release()
+        self.state_thread.join()
+        self.output.stop()
         self.stop_event.clear()
         print("Stopped voice thread")
         
         
-class Speech_Recognition(Thread):
-    stop_event = Event()
+class STTBackend():
+    # Speech to text backends get the audio of one turn chunk by chunk (int16 mono numpy arrays)
+    # while the person is still talking. feed() may return a partial transcription, finish()
+    # returns the final one, or None if nothing was understood.
+    # The base class just collects the audio for backends that need the whole recording.
+    name = "None"
+    sample_rate = 16000
 
-    r : sr.Recognizer = None
-    m : sr.Microphone = None
-    record_request = queue.Queue(1)
+    def start(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.chunks = []
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        return None
+
+    def finish(self):
+        return None
+
+    def audio_data(self) -> sr.AudioData:
+        audio = np.concatenate(self.chunks) if self.chunks else np.zeros(0, np.int16)
+        return sr.AudioData(audio.tobytes(), self.sample_rate, 2)
+
+
+class GoogleBackend(STTBackend):
+    name = "Google Speech Recognition"
+
+    def __init__(self, recognizer=None, key=None) -> None:
+        self.r = recognizer if recognizer is not None else sr.Recognizer()
+        self.key = key
+
+    def finish(self):
+        try:
+            return self.r.recognize_google(self.audio_data(), key=self.key)
+        except sr.UnknownValueError:
+            return None
+        except sr.RequestError as e:
+            print("Could not request results from Google Speech Recognition service; {0}".format(e))
+            return None
 
-    listen_state_change_callback_list = []
 
-    def __init__(self):
+class VoskBackend(STTBackend):
+    # Offline streaming recognition, the audio is decoded as it arrives so the final
+    # transcript is ready right after the turn ends. Needs `pip install vosk` and a model from
+    # https://alphacephei.com/vosk/models unpacked at model_path.
+    name = "Vosk"
+
+    def __init__(self, model_path="vosk-model") -> None:
+        if not has_vosk:
+            raise ValueError("Vosk backend requested but vosk is not installed")
+        self.model = vosk.Model(model_path)
+
+    def start(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.recognizer = vosk.KaldiRecognizer(self.model, sample_rate)
+        self.text = ""
+
+    def feed(self, chunk):
+        if self.recognizer.AcceptWaveform(chunk.tobytes()):
+            self.text = (self.text + " " + json.loads(self.recognizer.Result())["text"]).strip()
+            partial = ""
+        else:
+            partial = json.loads(self.recognizer.PartialResult())["partial"]
+        return (self.text + " " + partial).strip() or None
+
+    def finish(self):
+        text = (self.text + " " + json.loads(self.recognizer.FinalResult())["text"]).strip()
+        return text or None
+
+
+class ScriptedBackend(STTBackend):
+    # Deterministic stand-in for the recognizer, selected with STT_BACKEND=scripted. It "hears" the
+    # given transcripts in turn (one per line of STT_SCRIPT), revealing words_per_second words of
+    # the current one as partials while audio is fed, so the button, recording and answer path can
+    # be tried without a recognition service.
+    name = "Scripted"
+
+    def __init__(self, transcripts, words_per_second=3) -> None:
+        self.transcripts = transcripts
+        self.words_per_second = words_per_second
+        self.turn = 0
+
+    def start(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.samples = 0
+
+    def feed(self, chunk):
+        self.samples += len(chunk)
+        words = self.transcripts[self.turn % len(self.transcripts)].split()
+        heard = int(self.samples / self.sample_rate * self.words_per_second)
+        return " ".join(words[:heard]) or None
+
+    def finish(self):
+        transcript = self.transcripts[self.turn % len(self.transcripts)]
+        self.turn += 1
+        return transcript
+
+
+class Speech_Recognition(Thread):
+    stop_event: Event = None
+
+    r : sr.Recognizer = None
+    backend: STTBackend = None
+    record_request: queue.Queue = None
+    stop_recording_event: Event = None
+
+    bus: EventBus = None
+
+    # The microphone is captured all the time into a ring buffer, so a recording starts with
+    # pre_roll seconds of audio from before the button press. A chunk is speech when its RMS is
+    # speech_ratio times above the noise floor, which keeps adapting while nobody is talking.
+    # The turn ends after end_silence seconds of silence following speech.
+    sample_rate = 16000
+    chunk_size = 480  # 30 ms
+    pre_roll = 0.5
+    end_silence = 0.7
+    start_timeout = 5
+    max_phrase = 10
+    speech_ratio = 3.0
+    min_threshold = 100
+    noise_floor = None
+
+    stream: sounddevice.InputStream = None
+    recording = False
+    last_partial = None
+
+    def __init__(self, device=None, backend=None, bus=None):
         super().__init__()
+        self.stop_event = Event()
+        self.record_request = queue.Queue(1)
+        self.stop_recording_event = Event()
+        self.bus = bus if bus is not None else EventBus()
         self.r = sr.Recognizer()
-        self.m = sr.Microphone()
-        print(self.m.list_microphone_names())
-        with self.m as source:
-            self.r.adjust_for_ambient_noise(source, duration=1)
+        self.backend = backend if backend is not None else GoogleBackend(self.r)
+        print(sr.Microphone.list_microphone_names())
 
-    def register_listen_state_change_callback(self, callback):
-        self.listen_state_change_callback_list.append(callback)
+        self.capture_lock = Lock()
+        self.ring = deque(maxlen=int(self.pre_roll * self.sample_rate / self.chunk_size))
+        self.chunk_queue = queue.Queue(-1)
+        self.stream = sounddevice.InputStream(samplerate=self.sample_rate, channels=1, dtype="int16",
+                                              blocksize=self.chunk_size, device=device, callback=self.capture_callback)
+        self.stream.start()
+
+        # Give the noise floor a second to settle, like adjust_for_ambient_noise used to
+        time.sleep(1)
+        print("Noise floor: " + str(self.noise_floor))
+
+    def register_listen_state_change_callback(self, callback, post=None, poll=False):
+        return self.bus.subscribe("speech.listen_state", callback, post=post, poll=poll)
 
     def unregister_listen_state_change_callback(self, callback):
-        self.listen_state_change_callback_list.remove(callback) 
+        self.bus.unsubscribe("speech.listen_state", callback)
+
+    # Only the latest partial transcription matters, older ones are skipped
+    def register_partial_transcription_callback(self, callback, post=None, poll=False):
+        return self.bus.subscribe("speech.partial", callback, coalesce=True, post=post, poll=poll)
+
+    def unregister_partial_transcription_callback(self, callback):
+        self.bus.unsubscribe("speech.partial", callback)
+
+    def feed_backend(self, chunk):
+        partial = self.backend.feed(chunk)
+        if partial is not None and partial != self.last_partial:
+            self.last_partial = partial
+            self.bus.publish("speech.partial", partial)
 
-    def start_recording(self, return_queue):
+    def start_recording(self, return_queue, trace=untraced):
+        # return_queue gets (transcription, trace)
         print("Setting record request")
-        self.record_request.put_nowait(return_queue)
+        self.record_request.put_nowait((return_queue, trace))
 
     def stop_recording(self):
-        pass
-        #self.record_request.clear()
+        self.stop_recording_event.set()
 
     def stop(self):
         self.stop_event.set()
 
+    def rms(self, chunk):
+        return float(np.sqrt(np.mean(chunk.astype(np.float32) ** 2)))
+
+    def update_noise_floor(self, level):
+        if self.noise_floor is None:
+            self.noise_floor = level
+        else:
+            # Follow quiet moments quickly, but loud ones slowly so speech doesn't become the floor
+            rate = 0.5 if level < self.noise_floor else 0.02
+            self.noise_floor += rate * (level - self.noise_floor)
+
+    def speech_threshold(self):
+        return max(self.min_threshold, (self.noise_floor or 0) * self.speech_ratio)
+
+    def capture_callback(self, indata, frames, time_info, status):
+        chunk = indata[:, 0].copy()
+        with self.capture_lock:
+            if self.recording:
+                self.chunk_queue.put_nowait(chunk)
+            else:
+                self.ring.append(chunk)
+                self.update_noise_floor(self.rms(chunk))
+
+    def record(self):
+        with self.capture_lock:
+            chunks = list(self.ring)
+            self.ring.clear()
+            self.recording = True
+            self.stop_recording_event.clear()
+
+        # The backend hears the audio while the person is still talking
+        self.backend.start(self.sample_rate)
+        self.last_partial = None
+        for chunk in chunks:
+            self.feed_backend(chunk)
+
+        chunk_time = self.chunk_size / self.sample_rate
+        heard_speech = any(self.rms(chunk) > self.speech_threshold() for chunk in chunks)
+        elapsed = 0.0
+        silence = 0.0
+        while elapsed < self.max_phrase and not self.stop_recording_event.is_set() and not self.stop_event.is_set():
+            try:
+                chunk = self.chunk_queue.get(timeout=1)
+            except queue.Empty:
+                print("Microphone stopped delivering audio")
+                break
+            elapsed += chunk_time
+            self.feed_backend(chunk)
+
+            level = self.rms(chunk)
+            if level > self.speech_threshold():
+                heard_speech = True
+                silence = 0.0
+            else:
+                silence += chunk_time
+                self.update_noise_floor(level)
+                if heard_speech and silence >= self.end_silence:
+                    break
+                if not heard_speech and elapsed >= self.start_timeout:
+                    break
+
+        with self.capture_lock:
+            self.recording = False
+            while not self.chunk_queue.empty():
+                self.chunk_queue.get_nowait()
+
+        return heard_speech
+
     def run(self):
         print("Starting speech recognition thread")
         while not self.stop_event.is_set():
             return_queue: queue.Queue = None
             try:
-                return_queue = self.record_request.get(timeout=1)
+                (return_queue, trace) = self.record_request.get(timeout=1)
             except queue.Empty:
                 continue
 
             print("Recording audio...")
-            for callback in self.listen_state_change_callback_list:
-                callback(True)
-            # obtain audio from the microphone
-            r = sr.Recognizer()
-            with sr.Microphone() as source:
-                print("Say something!")
-                r.pause_threshold = 1.5
-                audio = r.listen(source, phrase_time_limit=10)
-
-            for callback in self.listen_state_change_callback_list:
-                callback(False)
+            self.bus.publish("speech.listen_state", True)
+            # obtain audio from the microphone, starting with the pre-roll
+            print("Say something!")
+            with trace.span("record"):
+                heard_speech = self.record()
+
+            self.bus.publish("speech.listen_state", False)
 
             print("Stopped recording audio")
 
-            # recognize speech using Google Speech Recognition
             transcription = "<voice was too quiet to understand>"
+            if not heard_speech:
+                print("No speech above the noise floor, skipping recognition")
+                return_queue.put((transcription, trace))
+                continue
+
             try:
-                # for testing purposes, we're just using the default API key
-                # to use another API key, use `r.recognize_google(audio, key="GOOGLE_SPEECH_RECOGNITION_API_KEY")`
-                # instead of `r.recognize_google(audio)`
-                transcription = r.recognize_google(audio)
-                print("Google Speech Recognition thinks you said " + transcription)
-            except sr.UnknownValueError:
-                print("Google Speech Recognition could not understand audio")
-            except sr.RequestError as e:
-                print("Could not request results from Google Speech Recognition service; {0}".format(e))
-
-            return_queue.put(transcription)
+                with trace.span("stt", backend=self.backend.name):
+                    result = self.backend.finish()
+                if result:
+                    transcription = result
+                    print(self.backend.name + " thinks you said " + transcription)
+                else:
+                    print(self.backend.name + " could not understand audio")
+            except Exception as e:
+                print(self.backend.name + " failed to transcribe audio: " + str(e))
+
+            return_queue.put((transcription, trace))
+
+        self.stream.close()
+        self.stop_event.clear()
+        print("Stopped speech recognition thread")
             
 
-ARRAY_WIDTH = 20
-ARRAY_HEIGHT = 10
-DISPLAY_SCALE = 20
+class AsyncRunner():
+    # One asyncio loop in its own thread with one pooled aiohttp session, for the AsyncPipelines
+    # of every pumpkin in the process (see SharedServices). At most max_concurrent_speech speech
+    # requests are in flight across all of them. The loop runs while at least one pipeline is started.
+    max_concurrent_speech = 3
+    connection_limit = 8
+
+    loop: asyncio.AbstractEventLoop = None
+    loop_thread: Thread = None
+    session: aiohttp.ClientSession = None
+    speech_limit: asyncio.Semaphore = None
+
+    def __init__(self, max_concurrent_speech=3, connection_limit=8) -> None:
+        self.max_concurrent_speech = max_concurrent_speech
+        self.connection_limit = connection_limit
+        self.lock = Lock()
+        self.users = 0
+
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+            if self.users > 1:
+                return
+            print("Starting pipeline thread")
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = Thread(target=self.run_loop, name="Pipeline")
+            self.loop_thread.start()
+            self.run(self.setup()).result()
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            print("Stopping pipeline thread")
+            self.run(self.session.close()).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+
+    def run(self, coroutine):
+        # Thread safe, returns a concurrent.futures.Future for the result
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+        print("Pipeline thread stopped")
+
+    async def setup(self):
+        self.session = aiohttp.ClientSession(headers=HEADERS, connector=aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=60))
+        self.speech_limit = asyncio.Semaphore(self.max_concurrent_speech)
+
+
+class AsyncPipeline():
+    # Runs question -> chat -> per line TTS -> download -> playback queue for one pumpkin on the
+    # AsyncRunner's loop, sharing its pooled aiohttp session. Other threads hand questions over
+    # with submit(). Answers come back through the message callbacks, and audio goes on the voice
+    # timeline, so the Tk and render threads don't change. Each question is a task that owns its
+    # speech tasks, so cancelling it cancels everything it started.
+    runner: AsyncRunner = None
+
+    def __init__(self, chat: Chat_Interface, voice: Voice_Control, max_concurrent_speech=3, runner=None) -> None:
+        self.chat = chat
+        self.voice = voice
+        self.runner = runner if runner is not None else AsyncRunner(max_concurrent_speech)
+        self.tasks = set()
 
-evil_factor = False
-speaking = False
+    def start(self):
+        self.runner.acquire()
+        self.runner.run(self.setup()).result()
 
-eye_mask = []
-for x in range(60, 100):
-    eye_mask.append(x)
+    def stop(self):
+        self.runner.run(self.shutdown()).result()
+        self.runner.release()
+
+    async def setup(self):
+        # Only one conversation turn at a time, but earlier answers keep speaking while the next is generated
+        self.turn_lock = asyncio.Lock()
+        self.chat.open_log()
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # Other pumpkins may still be using the loop, don't hold it up while the log is written out
+        await asyncio.get_running_loop().run_in_executor(None, self.chat.close_log)
+
+    def submit(self, question, trace=untraced):
+        # Thread safe, returns a concurrent.futures.Future for the answer text
+        print("Adding question to pipeline: " + question)
+        future = self.runner.run(self.handle(question, trace))
+        future.add_done_callback(self.handled)
+        return future
+
+    def handled(self, future):
+        # Nobody waits on the pumpkin's futures, so errors would vanish without this
+        if not future.cancelled() and future.exception() is not None:
+            print("Error answering question: " + repr(future.exception()))
+
+    def cancel_all(self):
+        # Thread safe, drops every question in flight along with its speech requests
+        def cancel():
+            for task in self.tasks:
+                task.cancel()
+        self.runner.loop.call_soon_threadsafe(cancel)
+
+    async def handle(self, question, trace):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        current_trace.set(trace)
+        session = self.runner.session
+        openai.aiosession.set(session)  # the chat requests use the same connection pool
+
+        speech_tasks = []
+        def on_segment(text, persona):
+            # Sequence numbers are taken in answer order, the timeline puts the clips back in order
+            clip = self.voice.new_clip(text, persona)
+            speech_tasks.append(asyncio.create_task(self.voice.speak_async(clip, session, self.runner.speech_limit)))
 
-mouth_mask = []
-for y in range(6, 10 ):
-    for x in range(5, 14):
-        mouth_mask.append(y* ARRAY_WIDTH + x)
+        try:
+            async with self.turn_lock:
+                answer = await self.chat.answer_async(question, on_segment)
+            await asyncio.gather(*speech_tasks)
+            return answer
+        except asyncio.CancelledError:
+            for speech_task in speech_tasks:
+                speech_task.cancel()
+            await asyncio.gather(*speech_tasks, return_exceptions=True)
+            raise
+        finally:
+            self.tasks.discard(task)
+
+
+ARRAY_WIDTH = 20
+ARRAY_HEIGHT = 10
+DISPLAY_SCALE = 20
 
-def show_none(x,y,t):
-        return [0,0,0]
-    
-def show_listening  (x,y,t):
-    brightness = 100
-    time_factor = 10
-
-    index = y * ARRAY_WIDTH + x
-    if(index in eye_mask):
-        return show_eyes(x,y,t)
-    elif(index in mouth_mask):
-        return show_mouth(x,y,t)
-
-    return [ int(brightness * (np.sin(t / time_factor + x / 2) + 1) / 2), int(brightness * (np.sin(t / time_factor + y / 2) + 1) / 2), int(brightness * (np.sin(t / time_factor + x / 2 + y / 2) + 1) / 2)]
-
-def show_idle(x,y,t):
-    index = y * ARRAY_WIDTH + x
-    if(index in eye_mask):
-        return show_eyes(x,y,t)
-    elif(index in mouth_mask):
-        return show_mouth(x,y,t)
-    
-    time_factor = 3 if speaking else 10
-    brightness = 255 if speaking else 100
-    array = [brightness if evil_factor else 0, int((np.sin(t / time_factor + x / 2) + 1) / 2 * brightness*y/ARRAY_HEIGHT), int((np.sin(t / time_factor + x / 2) + 1) / 2 * brightness*x/ARRAY_WIDTH)]
-    
-    if(speaking):
-        array = [array[0] + 40 * (np.sin(t*5)+1) / 2, array[1] + 40 * (np.sin(t*5)+1) / 2, array[2] + 40 * (np.sin(t*5)+1) / 2]
-        array = [int(min(255, max(0, x))) for x in array]
 
+# Face regions of the pumpkin, loaded from regions.json. Each region is a list of
+# rectangles {"x": [start, end], "y": [start, end]} (end exclusive) and/or a list of
+# raw "pixels" indices. Anything not covered by a region is the "background".
+default_regions = {
+    "eyes": [{"x": [0, 20], "y": [3, 5]}],
+    "mouth": [{"x": [5, 14], "y": [6, 10]}]
+}
 
-    return array
+def load_regions(region_file, width, height):
+    layout = default_regions
+    if region_file is not None:
+        try:
+            with open(region_file, "r") as f:
+                layout = json.load(f)
+        except FileNotFoundError:
+            print("Region file not found, using default regions")
+
+    regions = {}
+    for name, areas in layout.items():
+        mask = np.zeros((height, width), dtype=bool)
+        for area in areas:
+            if "pixels" in area:
+                pixels = np.array(area["pixels"], dtype=int)
+                if pixels.size and (pixels.min() < 0 or pixels.max() >= width * height):
+                    raise ValueError("Region " + name + " has pixels outside of the array")
+                mask.flat[pixels] = True
+            else:
+                (x0, x1), (y0, y1) = area["x"], area["y"]
+                if x0 < 0 or y0 < 0 or x1 > width or y1 > height:
+                    raise ValueError("Region " + name + " does not fit inside the array")
+                mask[y0:y1, x0:x1] = True
+        regions[name] = mask
+
+    regions["background"] = ~np.any(list(regions.values()), axis=0) if regions else np.ones((height, width), dtype=bool)
+    return regions
+
+regions = load_regions("regions.json", ARRAY_WIDTH, ARRAY_HEIGHT)
+
+# Each eye/mouth pixel gets a constant pair of shimmer rates, seeded by its index
+pixel_rates = np.zeros((2, ARRAY_HEIGHT, ARRAY_WIDTH))
+for index in range(ARRAY_HEIGHT * ARRAY_WIDTH):
+    random.seed(index)
+    pixel_rates[0].flat[index] = random.randint(6,18)
+    pixel_rates[1].flat[index] = random.randint(6,18)
+random.seed()
+
+# Shows render a whole frame at once: xx and yy are the pixel coordinate grids,
+# t is the tick, and the result is a (height, width, 3) uint8 array.
+# Layer renderers take the same arguments but only get the coordinates of the
+# pixels inside their region, and return one colour per coordinate.
+def frame_from_channels(red, green, blue):
+    frame = np.stack(np.broadcast_arrays(red, green, blue), axis=-1)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def looping(frames, while_speaking=True):
+    # Marks a layer renderer that repeats every `frames` frames, so FrameBanks can bake it.
+    # while_speaking=False for renderers that follow the voice while speaking.
+    def mark(renderer):
+        renderer.loop_frames = frames
+        renderer.loops_while_speaking = while_speaking
+        return renderer
+    return mark
+
+class FrameBanks():
+    # Looping layers are rendered once per variant (layer x speaking x evil_factor) over their
+    # loop into a contiguous uint8 bank, (frames, pixels, 3), and played back by indexing it
+    # with the frame number. Baking happens in the background, the layer is rendered live until
+    # its bank is ready. With bank_dir set, banks are also saved as .npy files and memory mapped
+    # on the next start. Layers that don't loop (or don't line up at the end of their loop)
+    # are always rendered live.
+    seam_tolerance = 2
+    enabled = True
+
+    def __init__(self, bank_dir=None) -> None:
+        self.bank_dir = bank_dir
+        self.lock = Lock()
+        self.banks = {}  # (renderer, region, speaking, evil_factor) -> bank, or None to render live
+        self.bake_threads = []
+
+    def lookup(self, renderer, region, xx, yy):
+        # The bank for this layer in the current variant, or None to render it live
+        if not self.enabled or getattr(renderer, "loop_frames", None) is None:
+            return None
+        state = show_state.get()
+        if state.speaking and not renderer.loops_while_speaking:
+            return None
 
-def show_eyes(x,y,t):
-    # set seed to make sure each pixel has a constant blink rate
-    random.seed(y * ARRAY_WIDTH + x)
-    array = np.array([0, int(150 + 30 * np.sin(t / random.randint(6,18) + t/10)), int(200 + 40 * np.sin(t / random.randint(6,18) + t/10 ))])
+        key = (renderer.__name__, region, state.speaking, state.evil_factor)
+        with self.lock:
+            if key in self.banks:
+                return self.banks[key]
+            self.banks[key] = None
+            thread = Thread(target=self.bake, args=(key, renderer, xx.copy(), yy.copy()), daemon=True)
+            self.bake_threads.append(thread)
+        thread.start()
+        return None
+
+    def bank_path(self, key, renderer, xx, yy):
+        if self.bank_dir is None:
+            return None
+        # Changing the renderer or the region makes a new file
+        digest = hashlib.sha256(marshal.dumps(renderer.__code__) + xx.tobytes() + yy.tobytes() +
+                                str(renderer.loop_frames).encode()).hexdigest()[:16]
+        return os.path.join(self.bank_dir, f"{key[0]}_{key[1]}_{int(key[2])}{int(key[3])}_{digest}.npy")
+
+    def matches(self, bank, renderer, xx, yy):
+        # Spot check a few frames against live rendering
+        for t in (0, len(bank) // 2, len(bank) - 1):
+            if np.abs(renderer(xx, yy, t).astype(int) - bank[t]).max() > self.seam_tolerance:
+                return False
+        return True
+
+    def bake(self, key, renderer, xx, yy):
+        show_state.set(ShowState(speaking=key[2], evil_factor=key[3]))
+        frames = renderer.loop_frames
+        path = self.bank_path(key, renderer, xx, yy)
+
+        bank = None
+        if path is not None and os.path.exists(path):
+            try:
+                bank = np.load(path, mmap_mode="r")
+                if bank.shape != (frames, len(xx), 3) or not self.matches(bank, renderer, xx, yy):
+                    bank = None
+            except (OSError, ValueError) as e:
+                print("Could not load frame bank " + path + ": " + str(e))
+                bank = None
+
+        if bank is None:
+            start = time.monotonic()
+            bank = np.empty((frames, len(xx), 3), np.uint8)
+            for t in range(frames):
+                bank[t] = renderer(xx, yy, t)
+                if t % 30 == 0:
+                    time.sleep(0.001)  # leave the show thread room to render
+            seam = np.abs(renderer(xx, yy, frames).astype(int) - bank[0]).max()
+            if seam > self.seam_tolerance:
+                print(f"{key[0]} on {key[1]} does not loop after {frames} frames, rendering it live")
+                return
+            print(f"Baked {frames} frames of {key[0]} on {key[1]} in {time.monotonic() - start:.1f} seconds")
+
+            if path is not None:
+                os.makedirs(self.bank_dir, exist_ok=True)
+                with open(path + ".tmp", "wb") as f:
+                    np.save(f, bank)
+                os.replace(path + ".tmp", path)
+
+        with self.lock:
+            self.banks[key] = bank
+
+    def wait(self):
+        # Wait for every bake started so far
+        with self.lock:
+            threads = list(self.bake_threads)
+        for thread in threads:
+            thread.join()
+
+# SHOW_BANK_DIR keeps baked frame banks on disk between runs
+frame_banks = FrameBanks(os.getenv("SHOW_BANK_DIR"))
+
+def layered_show(*layers):
+    # Composite (region name, renderer) layers from bottom to top
+    def frame_show(xx, yy, t):
+        frame = np.zeros(xx.shape + (3,), np.uint8)
+        for region, renderer in layers:
+            mask = regions[region][yy, xx]
+            if mask.any():
+                bank = frame_banks.lookup(renderer, region, xx[mask], yy[mask])
+                if bank is not None:
+                    frame[mask] = bank[int(t) % len(bank)]
+                else:
+                    frame[mask] = renderer(xx[mask], yy[mask], t)
+        return frame
+    return frame_show
+
+def pixel_show(show):
+    # Adapter for old style shows that return [r, g, b] for a single pixel
+    def frame_show(xx, yy, t):
+        frame = np.zeros(xx.shape + (3,), np.uint8)
+        for y in range(xx.shape[0]):
+            for x in range(xx.shape[1]):
+                frame[y, x] = show(int(xx[y, x]), int(yy[y, x]), t)
+        return frame
+    return frame_show
+
+def rainbow(xx, yy, t, brightness, time_factor):
+    return frame_from_channels(
+        np.trunc(brightness * (np.sin(t / time_factor + xx / 2) + 1) / 2),
+        np.trunc(brightness * (np.sin(t / time_factor + yy / 2) + 1) / 2),
+        np.trunc(brightness * (np.sin(t / time_factor + xx / 2 + yy / 2) + 1) / 2))
+
+def show_none(xx,yy,t):
+    return np.zeros(xx.shape + (3,), np.uint8)
+
+# The rainbows and pulses repeat every 20*pi frames (sin(t/10)), and 6 of those are 376.99 frames
+@looping(377)
+def slow_rainbow(xx,yy,t):
+    return rainbow(xx, yy, t, brightness=100, time_factor=10)
+
+@looping(377)
+def fast_rainbow(xx,yy,t):
+    return rainbow(xx, yy, t, brightness=100, time_factor=1)
+
+@looping(377, while_speaking=False)  # follows the voice while speaking
+def idle_background(xx,yy,t):
+    state = show_state.get()
+    time_factor = 3 if state.speaking else 10
+    brightness = 255 if state.speaking else 100
+    wave = (np.sin(t / time_factor + xx / 2) + 1) / 2
+    red = np.full(xx.shape, brightness if state.evil_factor else 0, dtype=float)
+    green = np.trunc(wave * brightness * yy / ARRAY_HEIGHT)
+    blue = np.trunc(wave * brightness * xx / ARRAY_WIDTH)
+
+    if(state.speaking):
+        pulse = 40 * state.mouth_level
+        red, green, blue = [np.trunc(np.clip(channel + pulse, 0, 255)) for channel in (red, green, blue)]
+
+    return frame_from_channels(red, green, blue)
+
+def shimmer(xx, yy, t):
+    green = np.trunc(150 + 30 * np.sin(t / pixel_rates[0][yy, xx] + t/10))
+    blue = np.trunc(200 + 40 * np.sin(t / pixel_rates[1][yy, xx] + t/10))
+    return np.zeros(xx.shape), green, blue
+
+def show_eyes(xx,yy,t):
+    state = show_state.get()
+    red, green, blue = shimmer(xx, yy, t)
 
     rate = 60
-    if speaking:
+    if state.speaking:
         rate -= 20
     rate += 0.2 * np.sin(t/30)  # add a little bit of variation to the blink rate
     blink_val = pow(abs((t % rate) - (rate/2)), 0.8) - 1 # make a curvy triangle wave
     blink_val = max(0, min(1, blink_val))
-    array = np.multiply(array, np.array([blink_val,blink_val,blink_val]))
-    
-    if evil_factor:
-        array = [array[2] , int(array[1] / 4.0), array[0]]
-
-    return array
- 
-def show_mouth(x,y,t):
-    random.seed(y * ARRAY_WIDTH + x)
-    array = np.array([0, int(150 + 30 * np.sin(t / random.randint(6,18) + t/10)), int(200 + 40 * np.sin(t / random.randint(6,18) + t/10 ))])
-
-    if speaking:
-        rate = 5
-        rate += 0.01 * np.sin((t + 6 * abs(x) + np.sin(t))/4) 
-        blink_val = pow(abs((t % rate) - (rate/2)), 0.8) - 1 
-        blink_val = max(0, min(1, blink_val))
-        array = np.multiply(array, np.array([blink_val,blink_val,blink_val]))
-
-    if evil_factor:
-        array = [array[2] , int(array[1] / 4.0), array[0]]
-
-    return array
-    
-    
+    red, green, blue = red * blink_val, green * blink_val, blue * blink_val
 
-def show_pulse_white(x,y,t):
-    brightness = 100
-    time_factor = 1
+    if state.evil_factor:
+        red, green, blue = blue, np.trunc(green / 4.0), red
 
-    index = y * ARRAY_WIDTH + x
-    if index in eye_mask or index in mouth_mask:
-        brightness += 30 * np.sin(t / 10 + x / 2 + y / 2)
-        return [brightness, brightness, brightness]
-     
-    #return [int(brightness * (np.sin(t) + 1) / 2), int(brightness * (np.sin(t) + 1) / 2), int(brightness * (np.sin(t) + 1) / 2)]
-    return [ int(brightness * (np.sin(t / time_factor + x / 2) + 1) / 2), int(brightness * (np.sin(t / time_factor + y / 2) + 1) / 2), int(brightness * (np.sin(t / time_factor + x / 2 + y / 2) + 1) / 2)]
+    return frame_from_channels(red, green, blue)
+
+def show_mouth(xx,yy,t):
+    state = show_state.get()
+    red, green, blue = shimmer(xx, yy, t)
+
+    if state.speaking:
+        # Open up with the voice, the corners of the mouth a little behind the middle
+        half_width = max(1, (xx.max() - xx.min()) / 2)
+        corner = np.abs(xx - (xx.min() + half_width)) / half_width
+        blink_val = np.clip(state.mouth_level * 1.5 - 0.5 * corner, 0, 1)
+        red, green, blue = red * blink_val, green * blink_val, blue * blink_val
+
+    if state.evil_factor:
+        red, green, blue = blue, np.trunc(green / 4.0), red
+
+    return frame_from_channels(red, green, blue)
+
+@looping(377)
+def face_pulse(xx,yy,t):
+    brightness = np.trunc(100 + 30 * np.sin(t / 10 + xx / 2 + yy / 2))
+    return frame_from_channels(brightness, brightness, brightness)
+
+show_listening = layered_show(("background", slow_rainbow), ("eyes", show_eyes), ("mouth", show_mouth))
+show_idle = layered_show(("background", idle_background), ("eyes", show_eyes), ("mouth", show_mouth))
+show_pulse_white = layered_show(("background", fast_rainbow), ("eyes", face_pulse), ("mouth", face_pulse))
 
 show_list = {
     "None": show_none,
@@ -652,77 +2674,334 @@ show_list = {
 
 
 
-output_points = np.zeros((ARRAY_HEIGHT, ARRAY_WIDTH, 3), np.uint8)
-try:
-    arduino = NeoPixelController('/dev/serial0')
-    arduino.start()
-except ValueError as e:
-    print("Error starting NeoPixel thread: " + str(e))
+def load_stock_lines(stock_file):
+    try:
+        with open(stock_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print("Stock lines file not found, only preparing the built in answers")
+        return []
+
+
+class ThinkingMusic():
+    # pygame has one music channel, so the thinking music plays while any pumpkin is thinking
+    def __init__(self, music_file="./thinking.mp3", volume=0.5) -> None:
+        self.music_file = music_file
+        self.volume = volume
+        self.lock = Lock()
+        self.loaded = False
+        self.thinking = set()
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                mixer.init()
+                mixer.music.load(self.music_file)
+                mixer.music.set_volume(self.volume)
+                self.loaded = True
+
+    def set_thinking(self, pumpkin, thinking):
+        with self.lock:
+            if thinking:
+                self.thinking.add(pumpkin)
+            else:
+                self.thinking.discard(pumpkin)
+
+            if self.thinking and not mixer.music.get_busy():
+                mixer.music.play(-1)
+            elif not self.thinking and mixer.music.get_busy():
+                mixer.music.stop()
+
+
+class SharedServices():
+    # What the pumpkins in one process share: the speech clip cache, the synthesis worker pool
+    # and its HTTP session, the asyncio pipeline loop and its aiohttp session, and the thinking
+    # music. A pumpkin on its own gets its own. Frame banks are shared by all shows anyway.
+    def __init__(self, clip_cache=None, synthesis_workers=3, queue_depth=16, max_concurrent_speech=3) -> None:
+        self.clip_cache = clip_cache if clip_cache is not None else ClipCache()
+        self.synthesis_pool = SynthesisPool(synthesis_workers, queue_depth)
+        self.runner = AsyncRunner(max_concurrent_speech)
+        self.thinking_music = ThinkingMusic()
+
+
+class Pumpkin(Thread):
+    # The pumpkin itself: LEDs, voice, chat, speech recognition and the listen -> think -> speak
+    # state machine that picks the show. Everything that happens (button presses, transcriptions,
+    # speech starting and stopping) is posted to the event queue and handled in order on this
+    # thread, so the pumpkin runs the same headless as with the GUI attached.
+    button_pin = 17
+
+    is_listening = False
+    is_typing = False
+    is_thinking = False
 
-show_control = ShowControl(show_list, output_points, ARRAY_WIDTH, ARRAY_HEIGHT, max_fps=30)
-show_control.start_show("Rainbow")
+    begin_sound = None
+    accept_sound = None
 
-voice_control = Voice_Control()
-voice_control.start()
+    shared: SharedServices = None
+    pipeline: AsyncPipeline = None
+
+    class Inbox():
+        # Stands in for a queue for threads that answer with put(item), and posts each item
+        # to the pumpkin's event queue instead
+        def __init__(self, pumpkin, handler) -> None:
+            self.pumpkin = pumpkin
+            self.handler = handler
+
+        def put(self, item, block=True, timeout=None):
+            self.pumpkin.post(self.handler, *item)
+
+    def __init__(self, serial_port='/dev/serial0', name="Pumpkin", shared=None, microphone=None, speaker=None,
+                 voice_ids=None, button_pin=17, prompt_file="prompt.md", chat_log_dir="chat_logs",
+                 stock_bundle="stock_clips.npz") -> None:
+        super().__init__(name=name)
+        self.events = queue.Queue()
+        self.transcriptions = self.Inbox(self, self.on_transcription)
+        self.bus = EventBus()
+        self.shared = shared if shared is not None else SharedServices()
+        self.button_pin = button_pin
+
+        self.voice_control = Voice_Control(clip_cache=self.shared.clip_cache, synthesis_pool=self.shared.synthesis_pool,
+                                           stock_bundle=stock_bundle, bus=self.bus, envelope_rate=30,
+                                           voice_ids=voice_ids, output_device=speaker)
+        self.show_control = ShowControl(show_list, ARRAY_WIDTH, ARRAY_HEIGHT, max_fps=30, bus=self.bus,
+                                        playback_position=self.voice_control.get_playback_position)
+        self.arduino = NeoPixelController(serial_port, self.show_control.frames)
+        self.chat = Chat_Interface(prompt_file=prompt_file, bus=self.bus, chat_log=ChatLog(chat_log_dir))
+
+        # PIPELINE=threads answers on the chat thread and synthesizes speech on the voice worker pool instead
+        if os.getenv("PIPELINE", "async").lower() == "async":
+            self.pipeline = AsyncPipeline(self.chat, self.voice_control, runner=self.shared.runner)
+
+        # STT_BACKEND=vosk (with VOSK_MODEL_PATH) switches to offline streaming recognition,
+        # STT_BACKEND=scripted hears the questions in STT_SCRIPT instead of what was said
+        stt_backend = os.getenv("STT_BACKEND", "google").lower()
+        if stt_backend == "vosk":
+            self.speech = Speech_Recognition(device=microphone, backend=VoskBackend(os.getenv("VOSK_MODEL_PATH", "vosk-model")), bus=self.bus)
+        elif stt_backend == "scripted":
+            with open(os.getenv("STT_SCRIPT", "questions.txt"), "r") as f:
+                transcripts = [line.strip() for line in f if line.strip()]
+            self.speech = Speech_Recognition(device=microphone, backend=ScriptedBackend(transcripts), bus=self.bus)
+        else:
+            self.speech = Speech_Recognition(device=microphone, bus=self.bus)
 
-chat = Chat_Interface()
-chat.start()
+    def start(self):
+        self.shared.thinking_music.load()
+        self.begin_sound = mixer.Sound("./begin.wav")
+        self.accept_sound = mixer.Sound("./accepted.wav")
 
-speech = Speech_Recognition()
-speech.start()
+        try:
+            self.arduino.start()
+        except ValueError as e:
+            print("Error starting NeoPixel thread: " + str(e))
 
+        # The serial output picks up frames from show_control.frames itself, state changes are
+        # handled on the pumpkin thread
+        self.show_control.start_show("Rainbow")
 
-class App:
-    active_show = "TwoAxis"
+        self.voice_control.register_audio_state_change_callback(self.on_audio_state_change, post=self.post)
+        self.voice_control.start()
 
-    new_message_event = Event() 
-    new_message_queue = queue.Queue(-1)
+        self.chat.register_message_update_callback(self.update_state, post=self.post)
+        if self.pipeline is not None:
+            self.pipeline.start()
+        else:
+            self.chat.register_segment_callback(self.on_answer_segment, post=self.post)
+            self.chat.start()
 
-    transcription_queue = queue.Queue(1)
+        self.voice_control.start_warm_up([self.chat.glitch_answer] + list(self.chat.stock_answers.values()) + load_stock_lines("stock_lines.json"))
 
-    is_listening = False 
-    is_thinking = False
+        self.speech.register_listen_state_change_callback(self.on_listen_status_change, post=self.post)
+        self.speech.start()
 
-    begin_sound = None
-    accept_sound = None
+        if is_rpi:
+            gpio.setmode(gpio.BCM)
+            gpio.setup(self.button_pin, gpio.IN, pull_up_down=gpio.PUD_DOWN)
+            gpio.add_event_detect(self.button_pin, gpio.RISING, callback=lambda channel: self.press_listen_button(), bouncetime=200)
 
-    last_hardware_button_state = False
-    
-    def __init__(self, tkroot:tk.Tk):
-        self.root = tkroot
-        self.root.title("Chat 'o' Lantern")
+        super().start()
 
-        mixer.init()
-        mixer.music.load("./thinking.mp3")
-        mixer.music.set_volume(0.5)
-        self.begin_sound = mixer.Sound("./begin.wav")
-        self.accept_sound = mixer.Sound("./accepted.wav")
+    def stop(self):
+        self.post(None)
+        self.join()
+
+    def post(self, handler, *args):
+        # Thread safe, handler(*args) runs on the pumpkin thread. None stops the pumpkin.
+        self.events.put((handler, args))
+
+    # Front ends (the GUI, the GPIO button) drive the pumpkin through these
+    def press_listen_button(self):
+        self.post(self.on_listen_button)
+
+    def ask(self, question, trace=None):
+        self.post(self.on_question, question, trace if trace is not None else tracer.new_trace("typed"))
+
+    def set_typing(self, typing):
+        self.post(self.on_typing, typing)
+
+    def on_listen_button(self):
+        if self.is_listening:
+            self.speech.stop_recording()
+        else:
+            self.speech.start_recording(self.transcriptions, tracer.new_trace("voice"))
+
+    def on_transcription(self, transcription, trace):
+        self.on_question(transcription, trace)
+
+    def on_question(self, question, trace):
+        if self.pipeline is not None:
+            self.pipeline.submit(question, trace)
+        else:
+            self.chat.ask(question, trace=trace)
+        self.is_thinking = True
+        self.update_state()
+
+    def on_typing(self, typing):
+        self.is_typing = typing
+        mixer.Sound.play(self.begin_sound if typing else self.accept_sound)
+        self.update_state()
+
+    def on_listen_status_change(self, new_status):
+        self.is_listening = new_status
+        mixer.Sound.play(self.begin_sound if new_status else self.accept_sound)
+        self.update_state()
+
+    def on_answer_segment(self, text, persona):
+        print("Speaking line as " + persona + ": " + text)
+        self.voice_control.speak(text, persona)
+        self.update_state()  # the chat stopped thinking, stop the music
+
+    def on_audio_state_change(self):
+        clip_info = self.voice_control.get_playing_clip_info()
+
+        state = self.show_control.state
+        state.speaking = clip_info is not None
+        state.evil_factor = clip_info is not None and clip_info.persona == "Malevolent"
+        if state.speaking:
+            self.is_listening = False
+            self.is_typing = False
+            self.is_thinking = False
+        self.update_state()
+
+    def update_state(self):
+        if self.is_thinking:
+            self.show_control.switch_show("Thinking")
+        elif self.is_listening or self.is_typing:
+            self.show_control.switch_show("Rainbow")
+        else:
+            self.show_control.switch_show("TwoAxis")
+
+        self.shared.thinking_music.set_thinking(self, self.chat.is_thinking())
+
+    def run(self):
+        print(self.name + " started")
+        while True:
+            (handler, args) = self.events.get()
+            if handler is None:
+                break
+            try:
+                handler(*args)
+            except Exception as e:
+                # Keep the pumpkin (and the others on the porch) going
+                print(self.name + " failed handling " + getattr(handler, "__name__", str(handler)) + ": " + str(e))
+
+        self.arduino.stop()
+        self.show_control.stop_show()
+        self.voice_control.stop()
+        self.speech.stop()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        else:
+            self.chat.stop()
+        self.shared.thinking_music.set_thinking(self, False)
+        self.bus.close()
+        print(self.name + " stopped")
+
+
+def load_pumpkin_configs(config_file):
+    # A list of Pumpkin arguments, one object per pumpkin, see pumpkins.json
+    with open(config_file, "r") as f:
+        configs = json.load(f)
+
+    names = [config.get("name") for config in configs]
+    ports = [config.get("serial_port") for config in configs]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError("Every pumpkin in " + config_file + " needs its own name")
+    if None in ports or len(set(ports)) != len(ports):
+        raise ValueError("Every pumpkin in " + config_file + " needs its own serial port")
+
+    for config in configs:
+        # Conversations and stock lines (which depend on the voices) are kept apart
+        config.setdefault("chat_log_dir", os.path.join("chat_logs", config["name"]))
+        config.setdefault("stock_bundle", "stock_clips_" + config["name"] + ".npz")
+    return configs
+
+
+class PumpkinSupervisor():
+    # Runs a whole porch of pumpkins in one process. Every pumpkin has its own serial port,
+    # microphone, speaker, voices, conversation and chat log, and they all share one
+    # SharedServices, so the clip cache, the HTTP connection pools and the synthesis workers are
+    # sized for the porch instead of once per pumpkin.
+    def __init__(self, configs, synthesis_workers_per_pumpkin=2, max_concurrent_speech_per_pumpkin=2) -> None:
+        count = len(configs)
+        self.shared = SharedServices(synthesis_workers=max(3, synthesis_workers_per_pumpkin * count), queue_depth=16 * count,
+                                     max_concurrent_speech=max(3, max_concurrent_speech_per_pumpkin * count))
+        self.pumpkins = [Pumpkin(shared=self.shared, **config) for config in configs]
+
+    def start(self):
+        for pumpkin in self.pumpkins:
+            pumpkin.start()
+
+    def stop(self):
+        # Thread safe
+        for pumpkin in self.pumpkins:
+            pumpkin.post(None)
+
+    def join(self):
+        for pumpkin in self.pumpkins:
+            pumpkin.join()
 
-        global is_rpi
-        if is_rpi:
-            gpio.setmode(gpio.BCM)
-            gpio.setup(17, gpio.IN, pull_up_down=gpio.PUD_DOWN)
-            gpio.add_event_detect(17, gpio.RISING, callback=self.on_listen_button_pressed, bouncetime=200)
+
+class App:
+    # Simulator GUI: the LED grid, the chat so far, and buttons to listen or type a question.
+    # Only a front end, the pumpkin runs the same without it (HEADLESS=1).
+    # tk, Image and ImageTk are only imported when spooky.py starts with the GUI.
+    partial_transcription = ""
+    is_listening = False
+
+    # Events are delivered on the Tk thread when update() polls them. Frames are coalesced, so
+    # the upscale into display_points and the image refresh happen at most once per update.
+    subscriptions = None
+    display_points: np.ndarray = None
+    shown_messages = None
+
+    def __init__(self, tkroot:"tk.Tk", pumpkin:Pumpkin):
+        self.root = tkroot
+        self.root.title("Chat 'o' Lantern")
+        self.pumpkin = pumpkin
 
         self.frame = tk.Frame(self.root)
         self.frame.pack()
 
-        show_control.register_update_callback(self.on_new_show_frame)
-        chat.register_message_update_callback(self.on_updated_message)
-        voice_control.register_audio_state_change_callback(self.on_audio_state_change)
-        speech.register_listen_state_change_callback(self.on_listen_status_change)
+        self.subscriptions = [
+            pumpkin.show_control.register_update_callback(self.on_new_show_frame, poll=True),
+            pumpkin.chat.register_message_update_callback(self.show_messages, poll=True),
+            pumpkin.speech.register_listen_state_change_callback(self.on_listen_status_change, poll=True),
+            pumpkin.speech.register_partial_transcription_callback(self.on_partial_transcription, poll=True)
+        ]
 
-        # Create an image from the NumPy array and display it
-        display_points = np.kron(output_points, np.ones((DISPLAY_SCALE, DISPLAY_SCALE, 1), dtype=np.uint8))
-        self.image = Image.fromarray(display_points)
+        # Create an image for the display buffer and display it
+        self.display_points = np.zeros((ARRAY_HEIGHT * DISPLAY_SCALE, ARRAY_WIDTH * DISPLAY_SCALE, 3), np.uint8)
+        self.image = Image.new("RGB", (self.display_points.shape[1], self.display_points.shape[0]))
         self.photo = ImageTk.PhotoImage(image=self.image)
+        self.shown_messages = []
         self.label = tk.Label(self.frame, image=self.photo)
         self.label.pack()
 
         self.text = tk.Text(self.frame, height=15, wrap=tk.WORD, width=200)
         self.text.pack(padx=5, pady=5)
 
-        self.listen_button = tk.Button(self.frame, text="Listen", command=self.on_listen_button_pressed)
+        self.listen_button = tk.Button(self.frame, text="Listen", command=pumpkin.press_listen_button)
         self.listen_button.pack(fill=tk.X, pady=5, padx=5)
 
         self.entry = tk.Entry(self.frame)
@@ -736,137 +3015,94 @@ class App:
         self.root.bind('<Return>', self.send_message)
         self.update()
 
-    def process_voice(self, text):
-        print("Processing voice lines...")
-        pattern = re.compile(r"\[.*?\]|[^[\]]+")
-        matches = pattern.findall(text)
-        matches = [match.strip() for match in matches if match.strip()]
-        
-        persona = "Benevolent"  # for any responses that don't have a persona specified, default to this
-        lines = []
-        for match in matches:
-            if match.startswith("[BEN]"):
-                persona = "Benevolent"
-            elif match.startswith("[MAL]"):
-                persona = "Malevolent"
-            elif match.startswith("["):
-                # process emotion tag
-                pass
-
-            else:
-                lines.append((match, persona))
-
-        for line in lines:
-            voice_control.speak(line[0], line[1])
-
-    def on_audio_state_change(self, event=None):
-        global evil_factor
-        global speaking
-        clip_info = voice_control.get_playing_clip_info()
-
-        if clip_info is not None:
-            speaking = True
-            self.is_listening = False
-            self.is_thinking = False
-        else:
-            speaking = False
-            
-
-        if clip_info is not None and clip_info.persona == "Malevolent":
-            evil_factor = True
-        else:
-            evil_factor = False
-
-    def on_listen_button_pressed(self, event=None):
-        if self.is_listening:
-            speech.stop_recording()         
-        else:
-            speech.start_recording(self.transcription_queue)
+    def on_partial_transcription(self, text):
+        self.partial_transcription = text
 
     def on_listen_status_change(self, new_status):
+        self.is_listening = new_status
         if new_status:
+            self.partial_transcription = ""
             self.listen_button.configure(text="Stop Listening...")
-            self.is_listening = True
-            mixer.Sound.play(self.begin_sound)
         else:
             self.listen_button.configure(text="Listen")
-            self.is_listening = False
-            mixer.Sound.play(self.accept_sound)
 
     def on_entry_focus_change(self, event=None):
-        if self.root.focus_get() == self.entry:
-            self.is_listening = True
-            mixer.Sound.play(self.begin_sound)
-        else :
-            self.is_listening = False
-            mixer.Sound.play(self.accept_sound)
+        self.pumpkin.set_typing(self.root.focus_get() == self.entry)
     
     def send_message(self, event=None):
         question = self.entry.get()
-        chat.ask(question, self.new_message_queue)
-        self.text.insert(tk.END, "You: " + question + "\n")
+        self.pumpkin.ask(question)
         self.entry.delete(0, tk.END)
-        root.focus()
-        self.is_thinking = True
+        self.root.focus()
         
-    def on_new_show_frame(self):
-        arduino.draw(output_points)
-        display_points = np.kron(output_points, np.ones((DISPLAY_SCALE, DISPLAY_SCALE, 1), dtype=np.uint8))
-        self.image = Image.fromarray(display_points)
-
-    def on_updated_message(self):
-        self.new_message_event.set()
+    def on_new_show_frame(self, sequence):
+        # Every LED becomes a DISPLAY_SCALE square: view the buffer as (y, scale, x, scale) blocks
+        # and broadcast the newest frame into it, without allocating anything
+        blocks = self.display_points.reshape(ARRAY_HEIGHT, DISPLAY_SCALE, ARRAY_WIDTH, DISPLAY_SCALE, 3)
+        with self.pumpkin.show_control.frames.read() as (sequence, frame):
+            blocks[:] = frame[:, None, :, None, :]
+        self.image.frombytes(self.display_points)  # decodes into the existing image
+        self.photo.paste(self.image)
+
+    def show_messages(self):
+        roles = { "user": "You", "assistant": "Pumpkin"}
+        message_list = self.pumpkin.chat.get_message_list()
+        if message_list[:len(self.shown_messages)] != self.shown_messages:
+            # The conversation was reset, start over
+            self.text.delete(1.0, tk.END)
+            self.shown_messages = []
 
-    
+        for message in message_list[len(self.shown_messages):]:
+            self.text.insert(tk.END, roles.get(message[0]) + ": " + message[1] + "\n")
+        self.shown_messages = message_list
+        self.text.see(tk.END)
 
     def update(self):                
-        if self.is_thinking:
-            show_control.switch_show("Thinking")
-        elif self.is_listening:
-            show_control.switch_show("Rainbow")
-        else:
-            show_control.switch_show("TwoAxis")
-
-        if chat.is_thinking() and not mixer.music.get_busy():
-            mixer.music.play(-1)
+        for subscription in self.subscriptions:
+            subscription.poll()
 
-        elif not chat.is_thinking()and mixer.music.get_busy():
-            mixer.music.stop()
-
-        if self.transcription_queue.empty() == False:
-            self.entry.insert(tk.END, self.transcription_queue.get())
-            self.send_message()
-
-        if self.new_message_event.is_set():
-            # Refresh Message List
-            self.text.delete(1.0, tk.END)
-            message_list = chat.get_message_list()
-            for message in message_list:
-                roles = { "user": "You", "assistant": "Pumpkin"}
-                self.text.insert(tk.END, roles.get(message[0]) + ": " + message[1] + "\n")
-            self.text.see(tk.END)
-
-            # TODO take this out because it gets played multiple times 
-            self.new_message_event.clear()
-            
-
-        if self.new_message_queue.empty() == False:
-            self.process_voice(self.new_message_queue.get())
-        
-    
-        # Refresh Image
-        self.photo = ImageTk.PhotoImage(image=self.image)
-        self.label.configure(image=self.photo)
+        if self.is_listening and self.partial_transcription:
+            self.listen_button.configure(text="Stop Listening... " + self.partial_transcription)
         
         self.root.after(100, self.update)
 
-root = tk.Tk()
-app = App(root)
-root.mainloop()
 
-arduino.stop()
-show_control.stop_show()
-voice_control.stop()
-speech.stop()
-chat.stop()
+# Importing spooky (e.g. from benchmark.py) only defines things, running it starts the pumpkin.
+# HEADLESS=1 (or --headless) runs without the simulator GUI, e.g. on a Pi with no display.
+# PUMPKINS=pumpkins.json (or --pumpkins pumpkins.json) runs every pumpkin in the file, headless.
+if __name__ == "__main__":
+    pumpkins_file = os.getenv("PUMPKINS")
+    if "--pumpkins" in sys.argv:
+        pumpkins_file = sys.argv[sys.argv.index("--pumpkins") + 1]
 
+    if pumpkins_file is not None:
+        supervisor = PumpkinSupervisor(load_pumpkin_configs(pumpkins_file))
+        supervisor.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+        try:
+            supervisor.join()
+        except KeyboardInterrupt:
+            supervisor.stop()
+            supervisor.join()
+        sys.exit(0)
+
+    headless = os.getenv("HEADLESS", "0") == "1" or "--headless" in sys.argv
+    if not headless:
+        # Only the simulator needs Tk, which a Pi without a display may not even have installed
+        import tkinter as tk
+        from PIL import Image, ImageTk
+
+    pumpkin = Pumpkin()
+    pumpkin.start()
+
+    if headless:
+        signal.signal(signal.SIGTERM, lambda signum, frame: pumpkin.post(None))
+        try:
+            pumpkin.join()
+        except KeyboardInterrupt:
+            pumpkin.stop()
+    else:
+        root = tk.Tk()
+        app = App(root, pumpkin)
+        root.mainloop()
+        pumpkin.stop()
@@ -0,0 +1,42 @@
+import sys
+import json
+import math
+from collections import defaultdict
+
+# Summarize the interaction traces written by spooky.py (traces.jsonl), per stage.
+# Usage: python trace_summary.py [traces.jsonl ...]
+
+# Order stages roughly the way an interaction flows through them
+stage_order = ["record", "stt", "llm_first_token", "llm", "tts_request", "download", "decode", "clip_latency", "first_audio"]
+
+def percentile(values, fraction):
+    # Nearest rank percentile of a sorted list
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+def load_durations(paths):
+    durations = defaultdict(list)
+    traces = set()
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short when the script was stopped
+                durations[record["stage"]].append(record["duration"])
+                traces.add(record["trace"])
+    return durations, traces
+
+def main(paths):
+    durations, traces = load_durations(paths)
+    print(str(len(traces)) + " interactions")
+    print(f'{"stage":<16}{"count":>8}{"p50":>10}{"p95":>10}{"p99":>10}{"max":>10}')
+    stages = [stage for stage in stage_order if stage in durations]
+    stages += sorted(stage for stage in durations if stage not in stage_order)
+    for stage in stages:
+        values = sorted(durations[stage])
+        print(f'{stage:<16}{len(values):>8}{percentile(values, 0.5):>10.3f}{percentile(values, 0.95):>10.3f}{percentile(values, 0.99):>10.3f}{values[-1]:>10.3f}')
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or ["traces.jsonl"])